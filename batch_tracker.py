@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+############################################################################
+#    Copyright 2010 Emli-Mari Nel
+#    This file is part of Opengazer-headtracker
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#    See <http://www.gnu.org/licenses/>
+############################################################################
+
+"""Headless batch tracking: run the HeadTracker over video files as fast as the machine allows 
+   (no Qt, no timer) and write the tracking output of every frame to a file.
+   Usage: batch_tracker.py [options] video1.avi [video2.avi ...]"""
+
+import os
+import sys
+import csv
+import time
+import numpy
+from optparse import OptionParser
+from head_tracker import HeadTracker
+from detection_scheduler import DetectionScheduler
+import motion_models
+from frame_grabber import FrameGrabberFile
+from detection_cache import DetectionCache
+import image_utils
+import latency
+
+#Columns of the output: frame number, time stamp in the video (s), time since the start of 
+#processing (s) and the HeadTracker.update output
+g_fields = ['frame', 'video_time', 'process_time', 'delta_x', 'delta_y', 'x', 'y', 'w', 'h']
+
+def trackVideo(i_file, i_head_tracker, i_scale=1., i_track=True, i_max_frames=None, i_latency_stats=None,
+               i_detection_cache=False):
+    """Track the head in all frames of a video file. 
+       Returns (results, stats): results is a n_frames x len(g_fields) array, stats a dictionary 
+       with the number of frames, total time and the time spent decoding and tracking (s).
+       The frame grabber latencies are added to i_latency_stats if given.
+       With i_detection_cache the face detections are stored next to the video and reused in 
+       later runs (see detection_cache.DetectionCache)."""
+    frame_grabber = FrameGrabberFile(i_file, i_loop_back = False, i_scale=i_scale)
+    frame_grabber.useBufferPool()
+    cache = None
+    try:
+        if i_latency_stats is not None:
+            frame_grabber.enableLatencyStats(True, i_latency_stats)
+        if i_detection_cache:
+            cache = DetectionCache(i_file, i_scale, i_head_tracker.violaScale(), i_n_frames=frame_grabber.frameCount())
+            i_head_tracker.setDetectionCache(cache)
+        results = image_utils.NumpyFrameBuffer( frame_grabber.frameCount() )
+        #The motion models use the video time: the results do not depend on the decoding and tracking speed
+        i_head_tracker.setClock( lambda: 0.001 * frame_grabber.framePosMsec() )
+        i_head_tracker.clearRoi()
+        grab_time = 0.
+        track_time = 0.
+        n_frames = 0
+        t_start = time.time()
+        while (i_max_frames is None) or (n_frames < i_max_frames):
+            t_grab = time.time()
+            current_frame = frame_grabber.nextFrame()
+            t_track = time.time()
+            if current_frame == None:
+                break
+            video_time = 0.001 * frame_grabber.framePosMsec()
+            (delta_x, delta_y, x, y, w, h) = i_head_tracker.update(frame_grabber.pyramid(), i_track=i_track, 
+                                                                    i_time=video_time,
+                                                                    i_frame=frame_grabber.frameIndex())
+            t_end = time.time()
+            grab_time += (t_track - t_grab)
+            track_time += (t_end - t_track)
+            results.append( numpy.array([n_frames, video_time, t_track - t_start, delta_x, delta_y, x, y, w, h]) )
+            n_frames += 1
+        total_time = time.time() - t_start
+    finally:
+        #The shared latency stats would otherwise keep the grabber (and its buffers) of every video alive
+        i_head_tracker.setClock(None)
+        frame_grabber.enableLatencyStats(False)
+        frame_grabber.release()
+        if cache is not None:
+            cache.flush()
+            i_head_tracker.setDetectionCache(None)
+    o_results = results.result()
+    if o_results is None:
+        o_results = numpy.zeros( (0, len(g_fields)) )
+    o_stats = { 'n_frames' : n_frames, 'total_time' : total_time, 'grab_time' : grab_time, 'track_time' : track_time }
+    return (o_results, o_stats)
+
+def saveResults(i_file, i_results):
+    """Binary (.npy, float64) if the file name ends with .npy, otherwise csv with a header"""
+    if i_file.endswith('.npy'):
+        numpy.save(i_file, i_results)
+        return
+    output = open(i_file, 'wb')
+    writer = csv.writer(output)
+    writer.writerow(g_fields)
+    for row in i_results:
+        writer.writerow( [int(row[0])] + ["%.6f" % value for value in row[1:]] )
+    output.close()
+    
+def printStats(i_file, i_stats):
+    n_frames = i_stats['n_frames']
+    fps = 0.
+    if i_stats['total_time'] > 0:
+        fps = n_frames / i_stats['total_time']
+    print "%s: %d frames in %.2f s (%.1f fps)" % (i_file, n_frames, i_stats['total_time'], fps)
+    if n_frames > 0:
+        print "    decode: %.2f ms/frame, track: %.2f ms/frame" % (1000. * i_stats['grab_time'] / n_frames,
+                                                                   1000. * i_stats['track_time'] / n_frames)
+    
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog [options] video1.avi [video2.avi ...]")
+    parser.add_option("-o", "--output-dir", dest="output_dir", default=None,
+                      help="directory of the output files (default: next to the videos)")
+    parser.add_option("-f", "--format", dest="format", default="csv", choices=["csv", "npy"],
+                      help="output format: csv or npy (binary float64) [default: %default]")
+    parser.add_option("-s", "--scale", dest="scale", type="float", default=1.0,
+                      help="capture scale [default: %default]")
+    parser.add_option("-v", "--viola-scale", dest="viola_scale", type="float", default=0.5,
+                      help="scale of the images for face detection [default: %default]")
+    parser.add_option("-n", "--max-frames", dest="max_frames", type="int", default=None,
+                      help="only process the first n frames of each video")
+    parser.add_option("--no-track", dest="track", action="store_false", default=True,
+                      help="detect the face once and keep the region of interest fixed")
+    parser.add_option("--search-window", dest="search_window", action="store_true", default=False,
+                      help="while tracking, only search for the face around the previous region of interest")
+    parser.add_option("--keyframes", dest="keyframes", type="float", default=None, metavar="TOLERANCE",
+                      help="only detect on adaptively scheduled keyframes, allowing a drift of TOLERANCE face widths")
+    parser.add_option("--frame-budget", dest="frame_budget", type="float", default=None, metavar="MS",
+                      help="with --keyframes: average tracking time per frame to stay below")
+    parser.add_option("--motion-model", dest="motion_model", type="choice", choices=["fixed", "exponential", "kalman"], 
+                      default="fixed", help="filter of the head position: fixed smoothing (default), exponential or kalman")
+    parser.add_option("--output-latency", dest="output_latency", type="float", default=0., metavar="MS",
+                      help="with --motion-model kalman: predict the head position this long after tracking")
+    parser.add_option("--detection-cache", dest="detection_cache", action="store_true", default=False,
+                      help="store the face detections next to each video and reuse them in later runs")
+    parser.add_option("--latency", dest="latency", action="store_true", default=False,
+                      help="report p50/p95/p99 latencies of each pipeline stage")
+    (options, args) = parser.parse_args()
+    if len(args) == 0:
+        parser.error("No video files given")
+    head_tracker = HeadTracker( i_viola_scale=options.viola_scale )
+    head_tracker.setSearchWindow( options.search_window )
+    if options.keyframes is not None:
+        frame_budget = None
+        if options.frame_budget is not None:
+            frame_budget = 0.001 * options.frame_budget
+        head_tracker.setDetectionScheduler( DetectionScheduler(i_tolerance=options.keyframes, i_frame_budget=frame_budget) )
+    if options.motion_model == "exponential":
+        head_tracker.setMotionModel( motion_models.ExponentialModel() )
+    elif options.motion_model == "kalman":
+        head_tracker.setMotionModel( motion_models.ConstantVelocityModel(), 0.001 * options.output_latency )
+    latency_stats = None
+    if options.latency:
+        latency_stats = latency.LatencyStats()
+        head_tracker.enableLatencyStats(True, latency_stats)
+    total = {'n_frames' : 0, 'total_time' : 0., 'grab_time' : 0., 'track_time' : 0.}
+    for file_name in args:
+        (results, stats) = trackVideo(file_name, head_tracker, options.scale, options.track, options.max_frames, 
+                                      latency_stats, options.detection_cache)
+        output_name = os.path.splitext(file_name)[0] + '.track.' + options.format
+        if options.output_dir is not None:
+            output_name = os.path.join(options.output_dir, os.path.basename(output_name))
+        saveResults(output_name, results)
+        printStats(file_name, stats)
+        for key in total.keys():
+            total[key] += stats[key]
+    if len(args) > 1:
+        printStats("Total", total)
+    if latency_stats is not None:
+        print latency_stats.report()
+    sys.exit(0)
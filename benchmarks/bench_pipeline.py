@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+############################################################################
+#    Copyright 2010 Emli-Mari Nel
+#    This file is part of Opengazer-headtracker
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#    See <http://www.gnu.org/licenses/>
+############################################################################
+
+"""Benchmark of the stages of the tracking pipeline, on synthetic frames of several 
+   resolutions and on a short video clip. Runs without a camera or display.
+   Usage:
+     bench_pipeline.py --make-clip                  write the synthetic clip (data/clip.avi), which 
+                                                    is also written when it is missing
+     bench_pipeline.py --save baselines/my_box.json store the results as a baseline
+     bench_pipeline.py --compare baselines/my_box.json  report stages slower than the baseline
+   The exit status is 1 if --compare found regressions."""
+
+import os
+import sys
+import json
+import time
+import struct
+import platform
+import numpy
+from optparse import OptionParser
+
+my_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(my_path))
+
+import opencv as cv
+import opencv.highgui
+import image_utils
+import viola_jones_opencv
+from image_normaliser import IplImageNormaliser
+from frame_grabber import FrameGrabberFile
+
+g_clip = os.path.join(my_path, 'data', 'clip.avi')
+g_resolutions = [(320, 240), (640, 480), (1280, 720)]
+g_viola_scales = [1.0, 0.5, 0.25]
+
+def timeStage(i_function, i_repeat, i_warmup=2):
+    """Time i_function (no arguments), returns statistics in milliseconds"""
+    for n in range(0, i_warmup):
+        i_function()
+    times = numpy.zeros(i_repeat)
+    for n in range(0, i_repeat):
+        t = time.time()
+        i_function()
+        times[n] = time.time() - t
+    times *= 1000.
+    return { 'median_ms' : float(numpy.median(times)), 'mean_ms' : float(numpy.mean(times)), 
+             'min_ms' : float(numpy.min(times)), 'p95_ms' : float(numpy.sort(times)[int(0.95 * (i_repeat - 1))]),
+             'repeat' : i_repeat }
+
+def syntheticArray(i_width, i_height, i_seed=0):
+    """A reproducible BGR test frame (rows x cols x 3 uint8): smooth gradients, a bright ellipse 
+       and noise"""
+    random_state = numpy.random.RandomState(i_seed)
+    (rows, cols) = numpy.mgrid[0:i_height, 0:i_width]
+    ellipse = ((cols - 0.5 * i_width) / (0.15 * i_width))**2 + ((rows - 0.45 * i_height) / (0.25 * i_height))**2
+    gray = 60. + 80. * cols / i_width + 100. * (ellipse < 1.) + random_state.normal(0., 8., (i_height, i_width))
+    frame = numpy.zeros( (i_height, i_width, 3), dtype=numpy.uint8)
+    for channel in range(0, 3):
+        frame[:, :, channel] = numpy.uint8( numpy.clip(gray + 10 * channel, 0, 255) )
+    return frame
+
+def syntheticFrame(i_width, i_height, i_seed=0):
+    """syntheticArray as an Ipl image"""
+    frame = syntheticArray(i_width, i_height, i_seed)
+    #Own copy of the data: the Ipl header would otherwise depend on the lifetime of frame
+    image = cv.cvCreateImage( cv.cvSize(i_width, i_height), 8, 3)
+    image_utils.IplNumpyView(image)[:] = frame
+    return image
+
+def riffChunk(i_id, i_data):
+    """A RIFF chunk, padded to an even size"""
+    o_chunk = i_id + struct.pack('<I', len(i_data)) + i_data
+    if len(i_data) % 2:
+        o_chunk += '\0'
+    return o_chunk
+
+def riffList(i_type, i_chunks):
+    return riffChunk('LIST', i_type + ''.join(i_chunks))
+
+def writeRawAvi(i_file, i_frames, i_fps=20):
+    """Write BGR frames (rows x cols x 3 uint8, cols a multiple of 4) as an uncompressed AVI. 
+       The file only depends on the frames, not on the codecs installed (as with FrameRecorder)."""
+    (height, width) = i_frames[0].shape[0:2]
+    frame_size = width * height * 3
+    n_frames = len(i_frames)
+    #Uncompressed AVI frames are bottom-up DIBs
+    movi = [ riffChunk('00db', frame[::-1, :, :].tostring()) for frame in i_frames ]
+    index = [ struct.pack('<4sIII', '00db', 0x10, 4 + n * (8 + frame_size), frame_size) for n in range(0, n_frames) ]
+    avih = struct.pack('<14I', 1000000 / i_fps, frame_size * i_fps, 0, 0x10, n_frames, 0, 1, frame_size, 
+                       width, height, 0, 0, 0, 0)
+    strh = struct.pack('<4s4sIHHIIIIIIIIhhhh', 'vids', 'DIB ', 0, 0, 0, 0, 1, i_fps, 0, n_frames, frame_size,
+                       0xffffffff, 0, 0, 0, width, height)
+    strf = struct.pack('<IiiHHIIiiII', 40, width, height, 1, 24, 0, frame_size, 0, 0, 0, 0)
+    header = riffList('hdrl', [ riffChunk('avih', avih), riffList('strl', [riffChunk('strh', strh), riffChunk('strf', strf)]) ])
+    data = 'AVI ' + header + riffList('movi', movi) + riffChunk('idx1', ''.join(index))
+    output = open(i_file, 'wb')
+    output.write( riffChunk('RIFF', data) )
+    output.close()
+
+def makeClip(i_file, i_n_frames=60, i_width=320, i_height=240):
+    """Write the synthetic clip of the decoding benchmark, identical on every machine"""
+    if not os.path.isdir(os.path.dirname(i_file)):
+        os.makedirs(os.path.dirname(i_file))
+    writeRawAvi( i_file, [syntheticArray(i_width, i_height, n) for n in range(0, i_n_frames)] )
+    
+def benchmarkFrame(i_width, i_height, i_repeat):
+    """Time all stages that work on a single frame"""
+    o_results = {}
+    suffix = "@%dx%d" % (i_width, i_height)
+    frame = syntheticFrame(i_width, i_height)
+    gray = image_utils.IplRGBToGray(frame)
+    o_results['cvFlip' + suffix] = timeStage(lambda: cv.cvFlip(frame, None, 1), i_repeat)
+    o_results['IplResize' + suffix] = timeStage(lambda: image_utils.IplResize(frame, i_width / 2, i_height / 2), i_repeat)
+    o_results['IplRGBToGray' + suffix] = timeStage(lambda: image_utils.IplRGBToGray(frame), i_repeat)
+    for scale in g_viola_scales:
+        w = int(round(i_width * scale))
+        h = int(round(i_height * scale))
+        small_image = image_utils.IplResize(gray, w, h)
+        for method in viola_jones_opencv.g_parameters.keys():
+            name = "viola_jones_opencv[%s,scale=%.2f]%s" % (method, scale, suffix)
+            o_results[name] = timeStage(lambda: viola_jones_opencv.viola_jones_opencv(small_image, i_method=method), i_repeat)
+    roi = cv.cvRect( i_width / 4, i_height / 4, i_width / 2, i_height / 2 )
+    normaliser = IplImageNormaliser()
+    normaliser.setParams( i_resize_scale=0.5, i_filter_size=3, i_eq=True, i_roi=roi)
+    o_results['normalise' + suffix] = timeStage(lambda: normaliser.normalise(gray), i_repeat)
+    normaliser.setAffineTransform( cv.cvPoint2D32f(i_width / 2, i_height / 2), 1.05, 10.)
+    o_results['normalise[affine]' + suffix] = timeStage(lambda: normaliser.normalise(gray), i_repeat)
+    normaliser.clearAffine()
+    o_results['jitter[10]' + suffix] = timeStage(lambda: normaliser.jitter(gray, 10), max(i_repeat / 10, 1))
+    if image_utils.QtGui is not None:
+        numpy_image = image_utils.IplNumpyView(gray).copy()
+        o_results['Ipl2QImage' + suffix] = timeStage(lambda: image_utils.Ipl2QImage(gray), i_repeat)
+        o_results['Numpy2QImage' + suffix] = timeStage(lambda: image_utils.Numpy2QImage(numpy_image), i_repeat)
+    return o_results
+
+def benchmarkClip(i_file, i_repeat):
+    """Time cvQueryFrame (decoding) on a video clip, looping back at the end of the clip"""
+    frame_grabber = FrameGrabberFile(i_file, i_loop_back = True)
+    if frame_grabber.grabFrame() == None:
+        raise IOError, "Could not read " + i_file + ", run with --make-clip first"
+    return { 'cvQueryFrame@clip' : timeStage(frame_grabber.grabFrame, i_repeat) }
+
+def compareResults(i_results, i_baseline, i_tolerance):
+    """Return the stages whose median time is more than (1 + i_tolerance) times the baseline"""
+    o_regressions = []
+    for (name, result) in sorted(i_results.items()):
+        if not i_baseline.has_key(name):
+            continue
+        ratio = result['median_ms'] / max(i_baseline[name]['median_ms'], 1E-6)
+        status = ""
+        if ratio > 1. + i_tolerance:
+            status = "  REGRESSION"
+            o_regressions.append(name)
+        print "%-60s %9.3f ms %9.3f ms %6.2fx%s" % (name, i_baseline[name]['median_ms'], result['median_ms'], ratio, status)
+    return o_regressions
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-r", "--repeat", dest="repeat", type="int", default=50, help="timings per stage [default: %default]")
+    parser.add_option("--resolutions", dest="resolutions", default=",".join(["%dx%d" % r for r in g_resolutions]),
+                      help="comma separated list of frame sizes [default: %default]")
+    parser.add_option("--clip", dest="clip", default=g_clip, help="video clip for the decoding benchmark [default: %default]")
+    parser.add_option("--make-clip", dest="make_clip", action="store_true", default=False, help="write the synthetic clip and exit")
+    parser.add_option("--stages", dest="stages", default=None, help="only report stages containing this string")
+    parser.add_option("--save", dest="save", default=None, help="save the results as a json baseline")
+    parser.add_option("--compare", dest="compare", default=None, help="compare with a json baseline")
+    parser.add_option("--tolerance", dest="tolerance", type="float", default=0.25,
+                      help="allowed relative slow down before a stage is reported as a regression [default: %default]")
+    (options, args) = parser.parse_args()
+    if options.make_clip or ((options.clip == g_clip) and (not os.path.exists(g_clip))):
+        makeClip(options.clip)
+        if options.make_clip:
+            sys.exit(0)
+    results = {}
+    for resolution in options.resolutions.split(","):
+        (width, height) = [int(value) for value in resolution.split("x")]
+        results.update( benchmarkFrame(width, height, options.repeat) )
+    if os.path.exists(options.clip):
+        results.update( benchmarkClip(options.clip, options.repeat) )
+    else:
+        print "No clip found at", options.clip, "- skipping the decoding benchmark"
+    if options.stages is not None:
+        results = dict([(name, result) for (name, result) in results.items() if options.stages in name])
+    if options.compare is not None:
+        baseline = json.load(open(options.compare))['results']
+        print "%-60s %12s %12s %7s" % ("stage", "baseline", "current", "ratio")
+        regressions = compareResults(results, baseline, options.tolerance)
+        if len(regressions) > 0:
+            print len(regressions), "stage(s) slower than the baseline"
+            sys.exit(1)
+    else:
+        for (name, result) in sorted(results.items()):
+            print "%-60s %9.3f ms (min %.3f, p95 %.3f)" % (name, result['median_ms'], result['min_ms'], result['p95_ms'])
+    if options.save is not None:
+        machine = { 'platform' : platform.platform(), 'processor' : platform.processor(), 
+                    'python' : platform.python_version(), 'date' : time.strftime("%Y-%m-%d %H:%M:%S") }
+        output = open(options.save, 'w')
+        json.dump( {'machine' : machine, 'repeat' : options.repeat, 'results' : results}, output, indent=1, sort_keys=True)
+        output.close()
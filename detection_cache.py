@@ -0,0 +1,144 @@
+############################################################################
+#    Copyright 2010 Emli-Mari Nel
+#    This file is part of Opengazer-headtracker
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#    See <http://www.gnu.org/licenses/>
+############################################################################
+
+import os
+import hashlib
+import json
+import numpy
+
+"""Face detections of video files cached in a sidecar file next to the video, so that repeated 
+   passes over the same recording (loop back, reprocessing with the offline tools) skip the 
+   detector for the frames it has seen before."""
+
+# Status of a frame in the cache
+g_unknown = 0
+g_face = 1
+g_no_face = 2
+
+class DetectionCache(object):
+    """The detections of one video with one detector setup, stored in 
+         <video>.<key>.detections.npy: n_frames x 5 int32, rows (status, min_row, min_col, max_row, max_col)
+       with the status g_unknown (not detected yet), g_face or g_no_face. The key is derived from 
+       the identity of the video (absolute path, modification time and size), the capture scale, 
+       the detector scale, the detector parameters and the sha1 of the cascade: any change uses a 
+       different sidecar file. The boxes are stored as returned by the detector (at the detector 
+       scale). The file is loaded when the cache is created and written by flush, which is called
+       every i_flush_interval new detections. i_param and i_cascade_name default to those of 
+       viola_jones_opencv; ViolaJonesRoi.setDetectionCache sets them to its own (see setDetector)."""
+    def __init__(self, i_file, i_capture_scale=1., i_detector_scale=1., i_param=None, i_cascade_name=None, 
+                 i_n_frames=0, i_flush_interval=256):
+        self.__file_name = os.path.abspath(i_file)
+        stat = os.stat(self.__file_name)
+        self.__video_key = "%s|%r|%d|%r|%r" % (self.__file_name, stat.st_mtime, stat.st_size, 
+                                               float(i_capture_scale), float(i_detector_scale))
+        self.__n_frames = max(i_n_frames, 0)
+        self.__flush_interval = i_flush_interval
+        self.__n_new = 0
+        self.__hits = 0
+        self.__misses = 0
+        self.__path = None
+        self.__detections = None
+        self.setDetector(i_param, i_cascade_name)
+        
+    def setDetector(self, i_param=None, i_cascade_name=None):
+        """Key the cache on the detector parameters and cascade (None: the defaults of 
+           viola_jones_opencv). The new detections of the previous setup are flushed first, 
+           the detections of the new setup are loaded from its sidecar file."""
+        import viola_jones_opencv
+        import haar_cascade
+        if i_param is None:
+            i_param = viola_jones_opencv.g_parameters['webcam']
+        if i_cascade_name is None:
+            i_cascade_name = viola_jones_opencv.g_cascade_name
+        key = "%s|%s|%s" % (self.__video_key, json.dumps(i_param, sort_keys=True), 
+                            haar_cascade.CascadeSha1(i_cascade_name))
+        path = "%s.%s.detections.npy" % (self.__file_name, hashlib.sha1(key).hexdigest()[:12])
+        if path == self.__path:
+            return
+        if self.__path is not None:
+            self.flush()
+        self.__path = path
+        self.__detections = None
+        if os.path.exists(self.__path):
+            try:
+                self.__detections = numpy.load(self.__path)
+            except (IOError, ValueError):
+                self.__detections = None
+        if (self.__detections is None) or (self.__detections.ndim != 2) or (self.__detections.shape[1] != 5):
+            self.__detections = numpy.zeros( (self.__n_frames, 5), dtype=numpy.int32 )
+            
+    def path(self):
+        return self.__path
+    
+    def isCached(self, i_frame):
+        """True if the frame has been detected before (with or without a face)"""
+        o_cached = (i_frame < self.__detections.shape[0]) and (self.__detections[i_frame, 0] != g_unknown)
+        if o_cached:
+            self.__hits += 1
+        else:
+            self.__misses += 1
+        return o_cached
+    
+    def box(self, i_frame):
+        """The cached box (min_row, min_col, max_row, max_col) of a frame, None if there was no face"""
+        if self.__detections[i_frame, 0] != g_face:
+            return None
+        return tuple([int(n) for n in self.__detections[i_frame, 1:]])
+    
+    def store(self, i_frame, i_box):
+        """Store the detection result of a frame, i_box = None if there was no face"""
+        if i_frame >= self.__detections.shape[0]:
+            #The frame count of the container was wrong or unknown
+            n_frames = max( 2 * self.__detections.shape[0], i_frame + 1, 1024 )
+            detections = numpy.zeros( (n_frames, 5), dtype=numpy.int32 )
+            detections[0:self.__detections.shape[0], :] = self.__detections
+            self.__detections = detections
+        if i_box is None:
+            self.__detections[i_frame, :] = [g_no_face, 0, 0, 0, 0]
+        else:
+            self.__detections[i_frame, :] = [g_face] + list(i_box)
+        self.__n_new += 1
+        if self.__n_new >= self.__flush_interval:
+            self.flush()
+        
+    def flush(self):
+        """Write the new detections to the sidecar file (via a temporary file, readers never see 
+           a partial file). Failures, e.g., a read-only directory, are ignored."""
+        if self.__n_new == 0:
+            return
+        tmp_file = self.__path + '.tmp%d' % os.getpid()
+        try:
+            output = open(tmp_file, 'wb')
+            try:
+                numpy.save(output, self.__detections)
+            finally:
+                output.close()
+            os.rename(tmp_file, self.__path)
+        except (IOError, OSError):
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        self.__n_new = 0
+        
+    def remove(self):
+        if os.path.exists(self.__path):
+            os.remove(self.__path)
+        self.__detections[:] = 0
+        self.__n_new = 0
+            
+    def stats(self):
+        return {'hits' : self.__hits, 'misses' : self.__misses, 
+                'cached' : int(numpy.sum(self.__detections[:,0] != g_unknown)) }
@@ -0,0 +1,174 @@
+############################################################################
+#    Copyright 2010 Emli-Mari Nel
+#    This file is part of Opengazer-headtracker
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#    See <http://www.gnu.org/licenses/>
+############################################################################
+
+import opencv as cv
+import numpy
+import image_utils
+
+"""Adaptive re-detection: the face detector only runs on keyframes, in between the face is 
+   followed by template matching, which is much cheaper."""
+
+class TemplateTracker(object):
+    """Cheap per-frame estimate of the face roi: the face patch of the last keyframe is matched 
+       (normalised cross correlation) inside a window around the previous estimate, enlarged by 
+       i_margin times the face size on each side."""
+    def __init__(self, i_margin=0.25):
+        self.__margin = i_margin
+        self.__template = None
+        self.__roi = None
+        self.__pool = image_utils.IplBufferPool()
+        
+    def hasTemplate(self):
+        return self.__template is not None
+    
+    def clear(self):
+        self.__template = None
+        self.__roi = None
+        
+    def setTemplate(self, i_ipl_image, i_face_roi):
+        """Store the face patch i_face_roi (min_row, min_col, max_row, max_col) of i_ipl_image"""
+        (min_row, min_col, max_row, max_col) = i_face_roi
+        min_row = max(min_row, 0)
+        min_col = max(min_col, 0)
+        max_row = min(max_row, i_ipl_image.height)
+        max_col = min(max_col, i_ipl_image.width)
+        if (max_row - min_row < 2) or (max_col - min_col < 2):
+            self.clear()
+            return
+        rect = image_utils.Numpy2CvRect(min_row, min_col, max_row, max_col)
+        self.__template = image_utils.CropImage(i_ipl_image, rect)
+        self.__roi = (min_row, min_col, max_row, max_col)
+        self.__pool.clear()
+        
+    def estimate(self, i_ipl_image):
+        """Return (face_roi, score) of the best match, score is in [-1, 1]. Returns None 
+           without a template or if the face is lost: the window, clipped at the image border, 
+           is smaller than the template."""
+        if self.__template is None:
+            return None
+        (min_row, min_col, max_row, max_col) = self.__roi
+        height = self.__template.height
+        width = self.__template.width
+        margin_rows = int(numpy.ceil(self.__margin * height))
+        margin_cols = int(numpy.ceil(self.__margin * width))
+        window_min_row = max(min_row - margin_rows, 0)
+        window_min_col = max(min_col - margin_cols, 0)
+        window_max_row = min(max_row + margin_rows, i_ipl_image.height)
+        window_max_col = min(max_col + margin_cols, i_ipl_image.width)
+        if (window_max_row - window_min_row < height) or (window_max_col - window_min_col < width):
+            return None
+        window = image_utils.Numpy2CvRect(window_min_row, window_min_col, window_max_row, window_max_col)
+        scores = self.__pool.getImage( window.width - width + 1, window.height - height + 1, 
+                                       cv.IPL_DEPTH_32F, 1, 'scores')
+        cv.cvSetImageROI(i_ipl_image, window)
+        try:
+            cv.cvMatchTemplate(i_ipl_image, self.__template, scores, cv.CV_TM_CCOEFF_NORMED)
+        finally:
+            cv.cvResetImageROI(i_ipl_image)
+        scores = image_utils.IplNumpyView(scores)
+        (row, col) = numpy.unravel_index( numpy.argmax(scores), scores.shape )
+        self.__roi = (window_min_row + row, window_min_col + col, window_min_row + row + height, 
+                      window_min_col + col + width)
+        return (self.__roi, float(scores[row, col]))
+
+class DetectionScheduler(object):
+    """Decides on which frames the (expensive) face detector runs. The interval between keyframes
+       adapts to:
+        * drift: on a keyframe the detection is compared with the template estimate. The interval 
+          is doubled (up to i_max_interval) if they differ by less than half of i_tolerance 
+          (relative to the face width) and halved if they differ by more than i_tolerance.
+        * confidence: a keyframe is forced if the template match score drops more than 
+          i_max_score_drop below its value on the first frame after the keyframe.
+        * frame time budget: the interval is large enough to keep the average time per frame 
+          (detection amortised over the interval) below i_frame_budget seconds, if given."""
+    def __init__(self, i_tolerance=0.1, i_max_interval=16, i_max_score_drop=0.2, i_frame_budget=None):
+        self.__tolerance = i_tolerance
+        self.__max_interval = i_max_interval
+        self.__max_score_drop = i_max_score_drop
+        self.__frame_budget = i_frame_budget
+        self.__detect_time = None   #Running averages in seconds
+        self.__track_time = None
+        self.__n_keyframes = 0
+        self.__n_frames = 0
+        self.reset()
+        
+    def reset(self):
+        """Start again with detection on every frame, e.g., when the roi is cleared"""
+        self.__interval = 1
+        self.__frames_since_keyframe = 0
+        self.__force_keyframe = True
+        self.__key_score = None
+    
+    def isKeyFrame(self):
+        return self.__force_keyframe or (self.__frames_since_keyframe >= self.__interval)
+    
+    def keyFrame(self, i_drift, i_detect_time):
+        """Report a keyframe: i_drift is the distance between the detected and estimated face 
+           centre divided by the face width (None without estimate)"""
+        self.__detect_time = self.__average(self.__detect_time, i_detect_time)
+        if i_drift is not None:
+            if i_drift > self.__tolerance:
+                self.__interval = max(self.__interval / 2, 1)
+            elif i_drift < 0.5 * self.__tolerance:
+                self.__interval = min(2 * self.__interval, self.__max_interval)
+        self.__interval = min( max(self.__interval, self.budgetInterval()), self.__max_interval )
+        self.__frames_since_keyframe = 1
+        self.__force_keyframe = False
+        self.__key_score = None
+        self.__n_keyframes += 1
+        self.__n_frames += 1
+        
+    def detectionFailed(self):
+        """No face was found on a keyframe: detect again on the next frame"""
+        self.reset()
+        self.__n_frames += 1
+        
+    def trackFrame(self, i_score, i_track_time):
+        """Report a frame tracked with the template estimate"""
+        self.__track_time = self.__average(self.__track_time, i_track_time)
+        if self.__key_score is None:
+            self.__key_score = i_score
+        elif (self.__key_score - i_score) > self.__max_score_drop:
+            self.__force_keyframe = True
+        self.__frames_since_keyframe += 1
+        self.__n_frames += 1
+        
+    def budgetInterval(self):
+        """Smallest interval for which (detect_time + (interval-1)*track_time)/interval <= budget"""
+        if (self.__frame_budget is None) or (self.__detect_time is None):
+            return 1
+        track_time = self.__track_time
+        if track_time is None:
+            track_time = 0.
+        spare_time = self.__frame_budget - track_time
+        if spare_time <= 0.:
+            return self.__max_interval
+        return max( int(numpy.ceil((self.__detect_time - track_time) / spare_time)), 1 )
+    
+    def __average(self, i_average, i_value, i_weight=0.1):
+        if i_average is None:
+            return i_value
+        return (1. - i_weight) * i_average + i_weight * i_value
+    
+    def stats(self):
+        o_stats = { 'interval' : self.__interval, 'keyframes' : self.__n_keyframes, 'frames' : self.__n_frames,
+                    'detect_ms' : None, 'track_ms' : None }
+        if self.__detect_time is not None:
+            o_stats['detect_ms'] = 1000. * self.__detect_time
+        if self.__track_time is not None:
+            o_stats['track_ms'] = 1000. * self.__track_time
+        return o_stats
@@ -18,24 +18,41 @@
 import opencv as cv
 import opencv.highgui  
 import image_utils
+import latency
 import time
+import threading
+import collections
 
 class FrameStore(object):
     """This class contains images of different formats, all derived from the basetype image.
        The basetype image is associated with a string ID, e.g., Ipl for opencv images, 
-       and a function pointer to handle image conversions."""
+       and a function pointer to handle image conversions.
+       Conversions are cached per frame: the generation counter is incremented by setFrame, 
+       which invalidates all converted images of the previous frame."""
     def __init__(self, i_id, i_converter ):
         self.__frames = {}
         self.__id = i_id
         self.__converter = i_converter
+        self.__formats = None
+        self.__generation = 0
+        self.__hits = 0
+        self.__misses = 0
+        
+    def setFormats(self, i_formats=None):
+        """Declare the formats that will be requested for every frame: they are then converted 
+           eagerly in one pass by setFrame. Set to None to convert on demand only."""
+        self.__formats = i_formats
+        
     def setFrame( self, i_image, i_formats=None ):
         """Update frame store.
            Inputs:  i_image: Image corresponding basetype image, 
                     i_formats: A list of string IDs associated with different formats.
-                               When i_formats = None, only the basetype format will be stored, i.e., 
-                               the i_image
+                               When i_formats = None, only the formats declared with setFormats
+                               will be stored along with the basetype format, i.e., the i_image
            Output:  A dictionary of images"""
-        self.__frames = {}
+        self.__generation += 1
+        if i_formats == None:
+            i_formats = self.__formats
         if i_formats == None:
             self.__frames = {self.__id : i_image}
         else:
@@ -46,6 +63,7 @@ class FrameStore(object):
                 if  self.__frames[self.__id] == None:
                     self.__frames[self.__id]  = i_image  
         return self.__frames
+    
     def getFrame(self, i_format):
         """Return the frame in the specified format.
         If the requested format has already been computed, simply return the 
@@ -55,11 +73,21 @@ class FrameStore(object):
             raise ValueError, msg
         else:
             if self.__frames.has_key(i_format):
+                self.__hits += 1
                 return self.__frames[i_format]
             else:
+                self.__misses += 1
                 image = self.__converter( self.__frames[self.__id],  [i_format])
+                self.__frames[i_format] = image[i_format]
                 return image[i_format]
-  
+            
+    def generation(self):
+        """The number of frames stored so far - can be used to check whether a frame has changed"""
+        return self.__generation
+    
+    def cacheStats(self):
+        return {'hits' : self.__hits, 'misses' : self.__misses, 'generation' : self.__generation}
+    
 class IplFrameStore(FrameStore):
     def __init__(self):
         FrameStore.__init__(self, 'Ipl', image_utils.Ipl2Formats)
@@ -68,6 +96,127 @@ class NumpyFrameStore(FrameStore):
      def __init__(self):
         FrameStore.__init__(self, 'Numpy', image_utils.Numpy2Formats)
     
+class FrameRing(object):
+    """A fixed ring of preallocated frames shared between a capture thread (producer) and
+       the consumer calling FrameGrabber.nextFrame. The slot handed to the consumer is never
+       written to until the consumer asks for the next frame.
+       Policies when the capture thread finds no free slot:
+        'drop_oldest': overwrite the oldest unread frame (webcam, lowest latency)
+        'block'      : wait for the consumer, frames are delivered in capture order (file playback)"""
+    def __init__(self, i_n_frames=3, i_policy='drop_oldest'):
+        if i_n_frames < 2:
+            raise ValueError, "A frame ring needs at least 2 frames"
+        if not (i_policy in ['drop_oldest', 'block']):
+            raise ValueError, "Unknown frame ring policy " + str(i_policy)
+        self.__pools = [image_utils.IplBufferPool() for n in range(0, i_n_frames)] #Preallocated images for each slot
+        self.__images = [None] * i_n_frames #The complete frame in each slot
+        self.__times = [None] * i_n_frames  #The time each frame was grabbed
+        self.__frame_indices = [None] * i_n_frames  #The index of each frame in the video (files only)
+        self.__ready = collections.deque()  #Slots with unread frames, oldest first
+        self.__reading = None               #Slot currently owned by the consumer
+        self.__policy = i_policy
+        self.__condition = threading.Condition()
+        self.__closed = False
+        self.__finished = False
+        self.__captured = 0
+        self.__dropped = 0
+        self.__stale = 0
+        
+    def pool(self, i_index):
+        """Return the buffer pool holding the preallocated images of slot i_index"""
+        return self.__pools[i_index]
+    
+    def acquireWrite(self):
+        """Return the index of a slot the producer can write to, or None if the ring has been closed"""
+        self.__condition.acquire()
+        try:
+            while not self.__closed:
+                busy = list(self.__ready) + [self.__reading]
+                free = [n for n in range(0, len(self.__images)) if not (n in busy)]
+                if len(free) > 0:
+                    return free[0]
+                if self.__policy == 'drop_oldest':
+                    self.__dropped += 1
+                    return self.__ready.popleft()
+                self.__condition.wait()
+            return None
+        finally:
+            self.__condition.release()
+            
+    def commitWrite(self, i_index, i_image, i_time=None, i_frame_index=None):
+        """Publish the complete frame i_image stored in slot i_index, grabbed at i_time"""
+        self.__condition.acquire()
+        try:
+            self.__images[i_index] = i_image
+            self.__times[i_index] = i_time
+            self.__frame_indices[i_index] = i_frame_index
+            self.__ready.append(i_index)
+            self.__captured += 1
+            self.__condition.notifyAll()
+        finally:
+            self.__condition.release()
+            
+    def acquireRead(self):
+        """Return (image, is_new): The newest complete frame ('drop_oldest') or the oldest unread 
+           frame ('block'). If no new frame is available the previous frame is returned again and
+           counted as stale. Never blocks, image is None when nothing can be returned."""
+        self.__condition.acquire()
+        try:
+            if len(self.__ready) > 0:
+                if self.__policy == 'drop_oldest':
+                    self.__reading = self.__ready.pop()
+                    self.__dropped += len(self.__ready)
+                    self.__ready.clear()
+                else:
+                    self.__reading = self.__ready.popleft()
+                self.__condition.notifyAll()
+                return (self.__images[self.__reading], True)
+            if self.__finished or (self.__reading is None):
+                return (None, False)
+            self.__stale += 1
+            return (self.__images[self.__reading], False)
+        finally:
+            self.__condition.release()
+    
+    def readTime(self):
+        """The time at which the frame last returned by acquireRead was grabbed"""
+        self.__condition.acquire()
+        try:
+            if self.__reading is None:
+                return None
+            return self.__times[self.__reading]
+        finally:
+            self.__condition.release()
+            
+    def readFrameIndex(self):
+        """The video frame index of the frame last returned by acquireRead"""
+        self.__condition.acquire()
+        try:
+            if self.__reading is None:
+                return None
+            return self.__frame_indices[self.__reading]
+        finally:
+            self.__condition.release()
+            
+    def finish(self):
+        """Called by the producer at the end of the stream"""
+        self.__condition.acquire()
+        self.__finished = True
+        self.__condition.notifyAll()
+        self.__condition.release()
+        
+    def close(self):
+        """Wake up and stop a blocked producer"""
+        self.__condition.acquire()
+        self.__closed = True
+        self.__condition.notifyAll()
+        self.__condition.release()
+        
+    def stats(self):
+        allocations = sum([pool.allocations() for pool in self.__pools])
+        return {'captured' : self.__captured, 'dropped' : self.__dropped, 'stale' : self.__stale, 
+                'allocations' : allocations }
+    
 class FrameGrabber(object):
     """Grab images from a capturing device - at the moment capture from file and real-time 
    camera capture are supported. Available formats:
@@ -76,52 +225,202 @@ class FrameGrabber(object):
     'Ipl', 'Numpy', 'QImage', 'PIL'
    All images are stored in a frame store which can be used as a separate module to e.g, 
    store a bunch of images derived from the same Ipl image when shared by many classes. 
-   Sequential processing assumed at the moment (i.e., not thread safe!) """
+   Sequential processing assumed at the moment (i.e., not thread safe!), except for the 
+   capture thread started with startCapture, which only talks to nextFrame through a FrameRing."""
     
  
     def __init__(self, i_capture_device, i_scale=1. , i_color=False):
         self.__current_frame = IplFrameStore()
+        self.__pyramid = image_utils.ImagePyramid()
+        self.__frame_time = None
+        self.__frame_index = None
         self.__capture_device = i_capture_device
         self.__scale = i_scale
         self.__time_start = time.time()
         self.__frame_cnt = 0
         self.__fps = 0
         self.__is_color = i_color
+        self.__ring = None
+        self.__capture_thread = None
+        self.__stop_capture = False
+        self.__pool = None
+        self.__latency_stats = None
         
     def release(self):
+        self.stopCapture()
         cv.highgui.cvReleaseCapture(self.__capture_device)
  
     def setScale(self, i_value):
         self.__scale = i_value
+        
+    def enableLatencyStats(self, i_enable=True, i_stats=None):
+        """Record the latency of nextFrame ('FrameGrabber.nextFrame') in i_stats (a new 
+           latency.LatencyStats if None). Costs nothing when disabled."""
+        if self.__latency_stats is not None:
+            self.__latency_stats.uninstrument(self)
+            self.__latency_stats = None
+        if i_enable:
+            if i_stats is None:
+                i_stats = latency.LatencyStats()
+            self.__latency_stats = i_stats
+            i_stats.instrument(self, 'nextFrame', 'FrameGrabber.nextFrame')
+            
+    def latencyStats(self):
+        """p50/p95/p99 latencies per stage, see latency.LatencyStats.summary"""
+        if self.__latency_stats is None:
+            return {}
+        return self.__latency_stats.summary()
+        
+    def useBufferPool(self, i_enable=True):
+        """Let nextFrame resize and convert frames into reused buffers instead of allocating 
+           new images for each frame. The returned image is only valid until the next call to 
+           nextFrame."""
+        if i_enable:
+            self.__pool = image_utils.IplBufferPool()
+        else:
+            self.__pool = None
+            
+    def bufferPool(self):
+        return self.__pool
+        
+    def startCapture(self, i_n_frames=3, i_policy='drop_oldest'):
+        """Decode, flip, resize and convert frames in a background thread into a ring of 
+           i_n_frames preallocated images (see FrameRing for the policies). nextFrame then 
+           returns the newest complete frame without waiting for the capturing device. 
+           The returned image is only valid until the next call to nextFrame."""
+        self.stopCapture()
+        self.__ring = FrameRing(i_n_frames, i_policy)
+        self.__stop_capture = False
+        self.__capture_thread = threading.Thread(target=self.__captureLoop)
+        self.__capture_thread.setDaemon(True)
+        self.__capture_thread.start()
+        
+    def stopCapture(self):
+        if self.__capture_thread is None:
+            return
+        self.__stop_capture = True
+        self.__ring.close()
+        self.__capture_thread.join()
+        self.__capture_thread = None
+        
+    def isCapturing(self):
+        return self.__capture_thread is not None
+        
+    def captureStats(self):
+        """Counters of the capture thread: number of frames captured, dropped (never returned 
+           by nextFrame) and stale (returned more than once)"""
+        if self.__ring is None:
+            return {'captured' : 0, 'dropped' : 0, 'stale' : 0, 'allocations' : 0 }
+        return self.__ring.stats()
+    
+    def grabFrame(self):
+        """Query the capturing device, returns None if no frame is available"""
+        return cv.highgui.cvQueryFrame(self.__capture_device)
+    
+    def grabbedFrameIndex(self):
+        """The index in the video of the frame returned by the last grabFrame, None for live capture"""
+        return None
+    
+    def __captureLoop(self):
+        ring = self.__ring
+        while not self.__stop_capture:
+            current_frame = self.grabFrame()
+            grab_time = latency.monotonic()
+            frame_index = self.grabbedFrameIndex()
+            if current_frame == None:
+                ring.finish()
+                break
+            index = ring.acquireWrite()
+            if index is None:
+                break
+            cv.cvFlip(current_frame, None, 1)
+            ring.commitWrite(index, self.__convertFrame(current_frame, ring, index), grab_time, frame_index)
+            
+    def __frameSize(self, i_frame):
+        if self.__scale < 1.0:
+            width = int(i_frame.width*self.__scale  + 0.5)
+            height = int(i_frame.height*self.__scale + 0.5)
+            return (width, height)
+        return (i_frame.width, i_frame.height)
+    
+    def __convertFrame(self, i_frame, i_ring, i_index):
+        """Resize and convert i_frame into the preallocated images of slot i_index"""
+        pool = i_ring.pool(i_index)
+        (width, height) = self.__frameSize(i_frame)
+        o_image = image_utils.IplResizeAndConvert(i_frame, width, height, self.__is_color, pool)
+        if o_image is i_frame:
+            #The capturing device owns i_frame, keep a copy in the ring 
+            o_image = pool.getImage(i_frame.width, i_frame.height, i_frame.depth, i_frame.nChannels, 'frame')
+            cv.cvCopy(i_frame, o_image)
+        return o_image
+    
+    def __publishFrame(self, i_frame, i_time=None, i_frame_index=None):
+        if i_time is None:
+            i_time = latency.monotonic()
+        self.__frame_time = i_time
+        self.__frame_index = i_frame_index
+        self.__current_frame.setFrame( i_frame )
+        self.__pyramid.setImage( i_frame )
+        t = time.time()
+        diff = t - self.__time_start
+        if diff > 1:
+            self.__fps =  self.__frame_cnt
+            self.__frame_cnt = 0
+            self.__time_start = t
+        else:
+            self.__frame_cnt += 1
 
     def nextFrame(self):
         """Read the next frame from the capturing device.
            Note that the captured image is flipped horisontally."""
-        current_frame = cv.highgui.cvQueryFrame(self.__capture_device )
+        if self.__capture_thread is not None:
+            (current_frame, is_new) = self.__ring.acquireRead()
+            if current_frame == None:
+                return None
+            if is_new:
+                self.__publishFrame(current_frame, self.__ring.readTime(), self.__ring.readFrameIndex())
+            return self.currentFrame()
+        current_frame = self.grabFrame()
+        grab_time = latency.monotonic()
+        frame_index = self.grabbedFrameIndex()
         if not( current_frame == None ):
             cv.cvFlip(current_frame, None, 1);
-          
-            if self.__scale < 1.0:
-                width = int(current_frame.width*self.__scale  + 0.5)
-                height = int(current_frame.height*self.__scale + 0.5)
-                current_frame = image_utils.IplResize(current_frame, width, height)
-                
-            if not self.__is_color: 
-                current_frame = image_utils.IplRGBToGray(  current_frame)
-        
-            self.__current_frame.setFrame( current_frame )
-            t = time.time()
-            diff = t - self.__time_start
-            if diff > 1:
-                self.__fps =  self.__frame_cnt
-                self.__frame_cnt = 0
-                self.__time_start = t
+            (width, height) = self.__frameSize(current_frame)
+            if self.__pool is None:
+                if self.__scale < 1.0:
+                    current_frame = image_utils.IplResize(current_frame, width, height)
+                if not self.__is_color: 
+                    current_frame = image_utils.IplRGBToGray(  current_frame)
             else:
-                self.__frame_cnt += 1
+                current_frame = image_utils.IplResizeAndConvert(current_frame, width, height, 
+                                                                self.__is_color, self.__pool)
+        
+            self.__publishFrame(current_frame, grab_time, frame_index)
             return self.currentFrame()
          
     def frameRate(self):
         return self.__fps
+    
+    def frameTime(self):
+        """The time (latency.monotonic) at which the current frame was grabbed from the device"""
+        return self.__frame_time
+    
+    def frameIndex(self):
+        """The index in the video of the current frame, None for live capture"""
+        return self.__frame_index
+    
+    def setFormats(self, i_formats=None):
+        """Formats (besides 'Ipl') that will be requested with currentFrame for each frame, 
+           see FrameStore.setFormats"""
+        self.__current_frame.setFormats(i_formats)
+        
+    def frameStore(self):
+        return self.__current_frame
+    
+    def pyramid(self):
+        """The image_utils.ImagePyramid of the most recently captured frame: pass it instead of 
+           the frame to share the resized levels between detection, normalisation and display"""
+        return self.__pyramid
   
     def currentFrame(self, i_format='Ipl'):
         """Return the most recently captured frame in the format specified -
@@ -149,18 +448,75 @@ class FrameGrabberFile(FrameGrabber):
     def __init__(self, i_file, i_loop_back = True, i_scale=1.,  i_color=False):
         FrameGrabber.__init__(self, cv.highgui.cvCreateFileCapture(i_file ), i_scale, i_color )
         self.loop_back = i_loop_back
+        self.__next_index = 0
+        self.__grabbed_index = None
     def restart(self, i_file, i_loop_back = True):
+        self.stopCapture()
         FrameGrabber.__init__(self, cv.highgui.cvCreateFileCapture(i_file ) )
         self.loop_back = i_loop_back
+        self.__next_index = 0
+        self.__grabbed_index = None
     def setFramePos(self, i_pos):
         cv.highgui.cvSetCaptureProperty(  self._FrameGrabber__capture_device, cv.highgui.CV_CAP_PROP_POS_FRAMES, i_pos )
-    def nextFrame(self):
-        current_frame = FrameGrabber.nextFrame(self)
+        self.__next_index = i_pos
+    def framePosMsec(self):
+        """Time stamp (in the video) of the most recently decoded frame in milliseconds"""
+        return cv.highgui.cvGetCaptureProperty( self._FrameGrabber__capture_device, cv.highgui.CV_CAP_PROP_POS_MSEC )
+    def framePos(self):
+        """Index of the next frame to be decoded"""
+        return int( cv.highgui.cvGetCaptureProperty( self._FrameGrabber__capture_device, cv.highgui.CV_CAP_PROP_POS_FRAMES ) )
+    def frameCount(self):
+        """The number of frames reported by the container - 0 if unknown, can be inaccurate"""
+        n_frames = cv.highgui.cvGetCaptureProperty( self._FrameGrabber__capture_device, cv.highgui.CV_CAP_PROP_FRAME_COUNT )
+        if not (n_frames > 0):
+            return 0
+        return int(n_frames)
+    def grabFrame(self):
+        current_frame = FrameGrabber.grabFrame(self)
         if ( current_frame == None) and (self.loop_back):
             self.setFramePos(0)
-            return  FrameGrabber.nextFrame(self)
-        else: 
-            return current_frame
+            current_frame = FrameGrabber.grabFrame(self)
+        #Frames are counted as they are decoded, the position reported by the container can be inexact
+        self.__grabbed_index = None
+        if not ( current_frame == None ):
+            self.__grabbed_index = self.__next_index
+            self.__next_index += 1
+        return current_frame
+    def grabbedFrameIndex(self):
+        return self.__grabbed_index
+        
+class FrameGrabberCache(FrameGrabber):
+    """Play back a video from a video_cache.VideoCache: frames are decoded (flipped, scaled and 
+       converted) once, after which they are read from the memory mapped cache without any 
+       decoding cost. The frames returned are Ipl headers of the cached data."""
+    def __init__(self, i_file, i_cache, i_loop_back = True, i_scale=1., i_color=False):
+        FrameGrabber.__init__(self, None, i_scale, i_color)
+        #Like the other frame grabbers, never scale up
+        self.__frames = i_cache.load(i_file, min(i_scale, 1.0), i_color)
+        self.__pos = 0
+        self.loop_back = i_loop_back
+    def release(self):
+        self.__frames = None
+    def startCapture(self, i_n_frames=3, i_policy='drop_oldest'):
+        """Frames are already decoded, there is nothing to do in a capture thread"""
+        pass
+    def setFramePos(self, i_pos):
+        self.__pos = i_pos
+    def frameCount(self):
+        if self.__frames is None:
+            return 0
+        return self.__frames.shape[0]
+    def nextFrame(self):
+        if self.__frames is None:
+            return None
+        if self.__pos >= self.__frames.shape[0]:
+            if not self.loop_back or (self.__frames.shape[0] == 0):
+                return None
+            self.__pos = 0
+        current_frame = image_utils.NumpyIplHeader( self.__frames[self.__pos] )
+        self.__pos += 1
+        self._FrameGrabber__publishFrame(current_frame, None, self.__pos - 1)
+        return self.currentFrame()
         
 if __name__ ==  "__main__":
     from PyQt4 import QtCore, QtGui
@@ -0,0 +1,149 @@
+############################################################################
+#    Copyright 2010 Emli-Mari Nel
+#    This file is part of Opengazer-headtracker
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#    See <http://www.gnu.org/licenses/>
+############################################################################
+
+import os
+import hashlib
+import numpy
+import xml.etree.cElementTree as ElementTree
+
+"""Pre-parsed Haar cascades: the OpenCV xml file is parsed once into numpy arrays, which are 
+   cached in a .npz file next to the xml file. The cache is invalidated by the sha1 of the xml file."""
+
+# Loaded cascades of this process, keyed by xml file name
+g_cascades = {}
+
+class HaarCascade(object):
+    """A stump based cascade (like haarcascade_frontalface_alt.xml) stored in arrays, with 
+       n_features the total number of features of all stages:
+        window_size:      (width, height) of the detection window
+        stage_thresholds: (n_stages,) 
+        stage_ends:       (n_stages,) the features of stage s are stage_ends[s-1]:stage_ends[s]
+        rects:            (n_features, 3, 5) rectangles (x, y, width, height, weight), 
+                          unused rectangles have weight 0
+        tilted:           (n_features,) tilted features (bool)
+        thresholds, left_vals, right_vals: (n_features,) the stumps"""
+    def __init__(self, i_arrays):
+        self.window_size = tuple(i_arrays['window_size'])
+        self.stage_thresholds = i_arrays['stage_thresholds']
+        self.stage_ends = i_arrays['stage_ends']
+        self.rects = i_arrays['rects']
+        self.tilted = i_arrays['tilted']
+        self.thresholds = i_arrays['thresholds']
+        self.left_vals = i_arrays['left_vals']
+        self.right_vals = i_arrays['right_vals']
+        self.sha1 = str(i_arrays['sha1'])
+        
+    def nStages(self):
+        return len(self.stage_thresholds)
+    
+    def stage(self, i_stage):
+        """Slice of the features of stage i_stage"""
+        start = 0
+        if i_stage > 0:
+            start = self.stage_ends[i_stage - 1]
+        return slice(start, self.stage_ends[i_stage])
+
+def CascadeSha1(i_xml_file):
+    f = open(i_xml_file, 'rb')
+    try:
+        return hashlib.sha1(f.read()).hexdigest()
+    finally:
+        f.close()
+        
+def CachePath(i_xml_file):
+    return os.path.splitext(i_xml_file)[0] + '.npz'
+
+def ParseCascade(i_xml_file):
+    """Parse an OpenCV haar cascade xml file into a dictionary of arrays, see HaarCascade"""
+    root = ElementTree.parse(i_xml_file).getroot()
+    cascade = root[0]
+    window_size = [int(n) for n in cascade.find('size').text.split()]
+    stage_thresholds = []
+    stage_ends = []
+    rects = []
+    tilted = []
+    stumps = []
+    for stage in cascade.find('stages'):
+        for tree in stage.find('trees'):
+            nodes = list(tree)
+            if (len(nodes) != 1) or (nodes[0].find('left_val') is None) or (nodes[0].find('right_val') is None):
+                raise ValueError, "Only stump based cascades are supported: " + i_xml_file
+            node = nodes[0]
+            feature = node.find('feature')
+            feature_rects = numpy.zeros((3, 5))
+            for (n, rect) in enumerate(feature.find('rects')):
+                feature_rects[n, :] = [float(v) for v in rect.text.split()]
+            rects.append(feature_rects)
+            tilted.append( int(feature.find('tilted').text) != 0 )
+            stumps.append( [float(node.find(tag).text) for tag in ['threshold', 'left_val', 'right_val']] )
+        stage_thresholds.append( float(stage.find('stage_threshold').text) )
+        stage_ends.append( len(stumps) )
+    stumps = numpy.array(stumps)
+    return { 'window_size' : numpy.int32(window_size), 
+             'stage_thresholds' : numpy.array(stage_thresholds),
+             'stage_ends' : numpy.int32(stage_ends),
+             'rects' : numpy.array(rects), 
+             'tilted' : numpy.array(tilted, dtype=numpy.bool),
+             'thresholds' : stumps[:,0].copy(), 
+             'left_vals' : stumps[:,1].copy(), 
+             'right_vals' : stumps[:,2].copy() }
+
+def LoadCachedArrays(i_cache_file, i_sha1):
+    """The arrays in i_cache_file if it was made from an xml file with hash i_sha1, otherwise None"""
+    if not os.path.exists(i_cache_file):
+        return None
+    try:
+        arrays = numpy.load(i_cache_file)
+        o_arrays = dict( [(key, arrays[key]) for key in arrays.files] )
+    except (IOError, ValueError, KeyError):
+        return None
+    if (not o_arrays.has_key('sha1')) or (str(o_arrays['sha1']) != i_sha1):
+        return None
+    return o_arrays
+    
+def SaveCachedArrays(i_cache_file, i_arrays):
+    """Written to a temporary file which is then renamed, readers never see a partial cache. 
+       Failures (e.g., a read-only directory) are ignored: the xml is parsed again next time."""
+    tmp_file = i_cache_file + '.tmp%d' % os.getpid()
+    try:
+        f = open(tmp_file, 'wb')
+        try:
+            numpy.savez(f, **i_arrays)
+        finally:
+            f.close()
+        os.rename(tmp_file, i_cache_file)
+    except (IOError, OSError):
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+def LoadCascade(i_xml_file, i_use_cache=True):
+    """Return the HaarCascade of i_xml_file: from this process if loaded before, otherwise from 
+       the .npz cache next to the xml file if it is up to date, otherwise parsed (and cached)."""
+    sha1 = CascadeSha1(i_xml_file)
+    if g_cascades.has_key(i_xml_file) and (g_cascades[i_xml_file].sha1 == sha1):
+        return g_cascades[i_xml_file]
+    cache_file = CachePath(i_xml_file)
+    arrays = None
+    if i_use_cache:
+        arrays = LoadCachedArrays(cache_file, sha1)
+    if arrays is None:
+        arrays = ParseCascade(i_xml_file)
+        arrays['sha1'] = numpy.array(sha1)
+        if i_use_cache:
+            SaveCachedArrays(cache_file, arrays)
+    g_cascades[i_xml_file] = HaarCascade(arrays)
+    return g_cascades[i_xml_file]
@@ -0,0 +1,247 @@
+############################################################################
+#    Copyright 2010 Emli-Mari Nel
+#    This file is part of Opengazer-headtracker
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#    See <http://www.gnu.org/licenses/>
+############################################################################
+
+import numpy
+import image_utils
+import haar_cascade
+from viola_jones_opencv import g_cascade_name, g_parameters, LargestBox
+
+"""Haar cascade face detection in numpy, as an alternative to cvHaarDetectObjects: the stages of 
+   the cascade are evaluated on an integral image for all candidate windows of a scale at once, 
+   only the windows accepted by a stage are passed to the next stage. The scales, window steps,
+   feature scaling, variance normalisation and grouping of the detections follow OpenCV 1.x."""
+
+# Subtracted from the stage thresholds as in OpenCV
+g_stage_threshold_bias = 0.0001
+# Maximum number of integral image look-ups per evaluation step (bounds the memory used)
+g_max_lookups = 2**22
+
+def IntegralImages(i_image):
+    """Integral image and integral of the squared image of a 2D array, both (rows+1) x (cols+1)"""
+    image = numpy.asarray(i_image, dtype=numpy.float64)
+    o_sum = numpy.zeros( (image.shape[0] + 1, image.shape[1] + 1) )
+    o_sq_sum = numpy.zeros( o_sum.shape )
+    o_sum[1:,1:] = numpy.cumsum( numpy.cumsum(image, axis=0), axis=1 )
+    o_sq_sum[1:,1:] = numpy.cumsum( numpy.cumsum(image**2, axis=0), axis=1 )
+    return (o_sum, o_sq_sum)
+
+def RectCorners(i_x, i_y, i_width, i_height, i_stride):
+    """Offsets of the (top left, top right, bottom left, bottom right) corners of rectangles in a 
+       flattened integral image with row length i_stride: the last axis of the output"""
+    top = i_y * i_stride
+    bottom = (i_y + i_height) * i_stride
+    return numpy.concatenate( [ (top + i_x)[...,numpy.newaxis], (top + i_x + i_width)[...,numpy.newaxis], 
+                                (bottom + i_x)[...,numpy.newaxis], (bottom + i_x + i_width)[...,numpy.newaxis] ], 
+                              axis=-1 )
+
+def RectSums(i_integral, i_corners):
+    """Sums of the rectangles with corners i_corners (see RectCorners) in a flattened integral image"""
+    return i_integral[i_corners[...,0]] - i_integral[i_corners[...,1]] - i_integral[i_corners[...,2]] + i_integral[i_corners[...,3]]
+
+def Round(i_values):
+    return numpy.int64(numpy.round(i_values))
+
+class ScaledCascade(object):
+    """The features of a cascade scaled by i_factor, as offsets in an integral image with rows of 
+       length i_stride, with the rectangle weights corrected as in cvSetImagesForHaarClassifierCascade"""
+    def __init__(self, i_cascade, i_factor, i_stride):
+        (win_width, win_height) = i_cascade.window_size
+        self.width = int(Round(win_width * i_factor))
+        self.height = int(Round(win_height * i_factor))
+        #The window used for the variance normalisation: one pixel border at the original scale
+        x = Round(i_factor)
+        y = Round(i_factor)
+        width = Round((win_width - 2) * i_factor)
+        height = Round((win_height - 2) * i_factor)
+        self.norm_corners = RectCorners(x, y, width, height, i_stride)
+        self.weight_scale = 1. / (width * height)
+        rects = i_cascade.rects
+        x = Round(rects[:,:,0] * i_factor)
+        y = Round(rects[:,:,1] * i_factor)
+        width = Round(rects[:,:,2] * i_factor)
+        height = Round(rects[:,:,3] * i_factor)
+        self.corners = RectCorners(x, y, width, height, i_stride)
+        areas = width * height
+        self.weights = rects[:,:,4] * self.weight_scale
+        self.weights[:,0] = -numpy.sum(self.weights[:,1:] * areas[:,1:], axis=1) / areas[:,0]
+        
+def GroupRects(i_rects, i_min_neighbors):
+    """Group similar detections (n x 4 rectangles x, y, width, height) as cvHaarDetectObjects: 
+       the average rectangles of the groups with at least i_min_neighbors members are returned, 
+       except those inside a rectangle supported by more detections"""
+    rects = numpy.int64(i_rects).reshape(-1, 4)
+    if (i_min_neighbors == 0) or (rects.shape[0] == 0):
+        return rects
+    (x, y, w, h) = [rects[:,n] for n in range(0, 4)]
+    distance = Round(w * 0.2)[:,numpy.newaxis]
+    similar = ( (numpy.abs(x[:,numpy.newaxis] - x) <= distance) & (numpy.abs(y[:,numpy.newaxis] - y) <= distance) &
+                (numpy.abs((x + w)[:,numpy.newaxis] - (x + w)) <= distance) & 
+                (numpy.abs((y + h)[:,numpy.newaxis] - (y + h)) <= distance) )
+    similar = similar | similar.T
+    #Connected components: propagate the smallest label until nothing changes
+    labels = numpy.arange(rects.shape[0])
+    while True:
+        new_labels = numpy.min( numpy.where(similar, labels, rects.shape[0]), axis=1 )
+        if numpy.all(new_labels == labels):
+            break
+        labels = new_labels
+    (groups, labels) = numpy.unique(labels, return_inverse=True)
+    neighbors = numpy.bincount(labels)
+    sums = numpy.array( [numpy.bincount(labels, rects[:,n]) for n in range(0, 4)] ).T
+    sums = numpy.int64(numpy.round(sums))
+    n = neighbors[:,numpy.newaxis]
+    groups = (sums * 2 + n) // (2 * n)
+    keep = neighbors >= i_min_neighbors
+    groups = groups[keep,:]
+    neighbors = neighbors[keep]
+    #Remove rectangles inside other rectangles (r1 inside r2)
+    (x, y, w, h) = [groups[:,n] for n in range(0, 4)]
+    distance = Round(w * 0.2)
+    inside = ( (x[:,numpy.newaxis] >= x - distance) & (y[:,numpy.newaxis] >= y - distance) & 
+               ((x + w)[:,numpy.newaxis] <= x + w + distance) & ((y + h)[:,numpy.newaxis] <= y + h + distance) &
+               ( (neighbors > numpy.maximum(3, neighbors)[:,numpy.newaxis]) | (neighbors < 3)[:,numpy.newaxis] ) )
+    inside[numpy.arange(len(neighbors)), numpy.arange(len(neighbors))] = False
+    return groups[ ~numpy.any(inside, axis=1), : ]
+
+class NumpyHaarDetector(object):
+    """Same interface as viola_jones_opencv.ViolaJonesDetector, with the cascade loaded through 
+       haar_cascade (stump based cascades without tilted features only). Counts how many windows
+       are evaluated and how many are rejected by each stage, see stats."""
+    def __init__(self, i_cascade_name=None, i_method='webcam', i_param=None):
+        if i_cascade_name is None:
+            i_cascade_name = g_cascade_name
+        self.__cascade_name = i_cascade_name
+        self.__cascade = haar_cascade.LoadCascade(i_cascade_name)
+        if numpy.any(self.__cascade.tilted):
+            raise ValueError, "Tilted features are not supported: " + i_cascade_name
+        self.__scaled = {}
+        self.resetStats()
+        self.setParams(i_method, i_param)
+        
+    def setParams(self, i_method='webcam', i_param=None):
+        if i_param is None:
+            i_param = g_parameters[i_method]
+        self.__param = dict(i_param)
+        
+    def params(self):
+        return dict(self.__param)
+    
+    def cascadeName(self):
+        return self.__cascade_name
+    
+    def resetStats(self):
+        self.__windows = 0
+        self.__rejections = numpy.zeros(self.__cascade.nStages(), dtype=numpy.int64)
+        
+    def stats(self):
+        """'windows': the number of windows evaluated, 'rejections': the number of windows 
+           rejected by each stage, 'accepted': the number of windows that passed all stages"""
+        return {'windows' : self.__windows, 'rejections' : self.__rejections.copy(), 
+                'accepted' : self.__windows - numpy.sum(self.__rejections) }
+    
+    def detect(self, i_image, i_min_size=None, i_max_size=None, i_param=None):
+        """See ViolaJonesDetector.detect"""
+        return LargestBox( self.detectAll(i_image, i_min_size, i_max_size, i_param) )
+    
+    def detectAll(self, i_image, i_min_size=None, i_max_size=None, i_param=None, i_all_faces=True):
+        """See ViolaJonesDetector.detectAll: i_image is an Ipl image or a 2D numpy array. The scales
+           with windows larger than i_max_size are not evaluated at all. All faces are returned
+           (i_all_faces is accepted for compatibility)."""
+        if i_param is None:
+            i_param = self.__param
+        image = self.__grayArray(i_image)
+        (rows, cols) = image.shape
+        if i_min_size is None:
+            min_length = max( int( float( cols ) * i_param['min_size'] + 0.5 ), 
+                              int( float( rows ) * i_param['min_size'] + 0.5 ) )
+        else:
+            min_length = int(i_min_size)
+        (integral, sq_integral) = IntegralImages(image)
+        integral = integral.ravel()
+        sq_integral = sq_integral.ravel()
+        (win_width, win_height) = self.__cascade.window_size
+        rects = []
+        factor = 1.
+        while (factor * win_width < cols - 10) and (factor * win_height < rows - 10):
+            scaled = self.__scaledCascade(factor, cols + 1)
+            if (i_max_size is not None) and (max(scaled.width, scaled.height) > i_max_size):
+                break
+            if (scaled.width >= min_length) and (scaled.height >= min_length):
+                rects.append( self.__detectScale(integral, sq_integral, rows, cols, factor, scaled) )
+            factor *= i_param['window_scale']
+        if len(rects) == 0:
+            return numpy.zeros((0, 4), dtype=numpy.int32)
+        rects = GroupRects( numpy.vstack(rects), i_param['min_neighbors'] )
+        o_boxes = numpy.int32( numpy.hstack( (rects[:,1:2], rects[:,0:1], rects[:,1:2] + rects[:,3:4], 
+                                              rects[:,0:1] + rects[:,2:3]) ) )
+        if i_max_size is not None:
+            o_boxes = o_boxes[ numpy.max(rects[:,2:4], axis=1) <= i_max_size, : ]
+        return o_boxes
+    
+    def __grayArray(self, i_image):
+        if isinstance(i_image, numpy.ndarray):
+            return i_image
+        if i_image.nChannels != 1:
+            i_image = image_utils.IplRGBToGray(i_image)
+        return image_utils.IplNumpyView(i_image)
+    
+    def __scaledCascade(self, i_factor, i_stride):
+        key = (i_factor, i_stride)
+        if not self.__scaled.has_key(key):
+            self.__scaled[key] = ScaledCascade(self.__cascade, i_factor, i_stride)
+        return self.__scaled[key]
+    
+    def __detectScale(self, i_integral, i_sq_integral, i_rows, i_cols, i_factor, i_scaled):
+        """All windows of one scale: returns the accepted windows as n x 4 rectangles (x, y, width, height)"""
+        cascade = self.__cascade
+        step = max(2., i_factor)
+        stop_height = int(Round( (i_rows - i_scaled.height) / step ))
+        stop_width = int(Round( (i_cols - i_scaled.width) / step ))
+        ys = Round( numpy.arange(stop_height) * step )
+        xs = Round( numpy.arange(stop_width) * step )
+        origins = ( ys[:,numpy.newaxis] * (i_cols + 1) + xs ).ravel()
+        if len(origins) == 0:
+            return numpy.zeros((0, 4), dtype=numpy.int64)
+        #Variance normalisation of each window
+        corners = origins[:,numpy.newaxis] + i_scaled.norm_corners
+        mean = RectSums(i_integral, corners) * i_scaled.weight_scale
+        variance = RectSums(i_sq_integral, corners) * i_scaled.weight_scale - mean**2
+        norms = numpy.ones(variance.shape)
+        norms[variance >= 0.] = numpy.sqrt(variance[variance >= 0.])
+        self.__windows += len(origins)
+        alive = numpy.arange(len(origins))
+        for stage in range(0, cascade.nStages()):
+            if len(alive) == 0:
+                break
+            features = cascade.stage(stage)
+            stage_corners = i_scaled.corners[features]
+            chunk_size = max( g_max_lookups // stage_corners.size, 1 )
+            passed = []
+            for start in range(0, len(alive), chunk_size):
+                windows = alive[start:start + chunk_size]
+                corners = origins[windows][:,numpy.newaxis,numpy.newaxis,numpy.newaxis] + stage_corners
+                sums = numpy.sum( RectSums(i_integral, corners) * i_scaled.weights[features], axis=2 )
+                thresholds = cascade.thresholds[features] * norms[windows][:,numpy.newaxis]
+                votes = numpy.where( sums < thresholds, cascade.left_vals[features], cascade.right_vals[features] )
+                passed.append( numpy.sum(votes, axis=1) >= (cascade.stage_thresholds[stage] - g_stage_threshold_bias) )
+            passed = numpy.concatenate(passed)
+            self.__rejections[stage] += len(passed) - numpy.sum(passed)
+            alive = alive[passed]
+        n_windows = len(alive)
+        return numpy.hstack( ( xs[alive % stop_width][:,numpy.newaxis], ys[alive // stop_width][:,numpy.newaxis], 
+                               numpy.ones((n_windows, 1), dtype=numpy.int64) * i_scaled.width, 
+                               numpy.ones((n_windows, 1), dtype=numpy.int64) * i_scaled.height ) )
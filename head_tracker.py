@@ -0,0 +1,185 @@
+
+############################################################################
+#    Copyright 2010 Emli-Mari Nel
+#    This file is part of Opengazer-headtracker
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#    See <http://www.gnu.org/licenses/>
+############################################################################
+
+from roi_detector import ViolaJonesRoi
+from image_normaliser import IplImageNormaliser
+from detection_scheduler import TemplateTracker
+import image_utils
+import latency
+import numpy
+ 
+class  HeadTracker(object): 
+    def __init__(self, i_viola_scale=0.5, i_img_resize_scale=1.0):
+         
+        self.__params = {
+            'filter_size' : 0,  
+            'viola_scale': i_viola_scale
+        }
+        self.__normaliser =  IplImageNormaliser()
+        self.__normaliser.setParams( i_resize_scale=i_img_resize_scale, i_filter_size=self.__params['filter_size'],
+                        i_eq=False, i_roi=None)
+        self.__roi_detector = ViolaJonesRoi( i_scale= self.__params['viola_scale'])
+        self.__latency_stats = None
+        self.__scheduler = None
+        self.__template_tracker = TemplateTracker()
+        
+    def setDetectionScheduler(self, i_scheduler=None):
+        """Only detect the face on the keyframes chosen by i_scheduler (a 
+           detection_scheduler.DetectionScheduler) while tracking, and follow it with template 
+           matching in between. None detects on every frame."""
+        self.__scheduler = i_scheduler
+        self.__template_tracker.clear()
+        if self.__scheduler is not None:
+            self.__scheduler.reset()
+        
+    def setDetectionCache(self, i_cache=None):
+        """Reuse the face detections of earlier passes over a video, see ViolaJonesRoi.setDetectionCache"""
+        self.__roi_detector.setDetectionCache(i_cache)
+        
+    def violaScale(self):
+        return self.__params['viola_scale']
+        
+    def setMotionModel(self, i_model=None, i_output_latency=0.):
+        """Filter the tracked head position with a motion model (see motion_models) predicting 
+           it i_output_latency seconds after update returns, instead of the fixed smoothing. 
+           Pass the frame times to update to compensate the capture and detection latency."""
+        self.__roi_detector.setMotionModel(i_model, i_output_latency)
+        
+    def pipelineLatency(self):
+        """See RoiDetector.pipelineLatency"""
+        return self.__roi_detector.pipelineLatency()
+    
+    def setClock(self, i_clock=None):
+        """The clock of the frame times passed to update, see RoiDetector.setClock"""
+        self.__roi_detector.setClock(i_clock)
+        
+    def enableLatencyStats(self, i_enable=True, i_stats=None):
+        """Record the latencies of update, detectRoi and RoiDetector.trackRoi in i_stats (a new 
+           latency.LatencyStats if None), share i_stats with FrameGrabber.enableLatencyStats 
+           to get all stages in one place. Costs nothing when disabled."""
+        if self.__latency_stats is not None:
+            self.__latency_stats.uninstrument(self)
+            self.__latency_stats.uninstrument(self.__roi_detector)
+            self.__latency_stats = None
+        if i_enable:
+            if i_stats is None:
+                i_stats = latency.LatencyStats()
+            self.__latency_stats = i_stats
+            i_stats.instrument(self, 'update', 'HeadTracker.update')
+            i_stats.instrument(self, 'detectRoi', 'HeadTracker.detectRoi')
+            i_stats.instrument(self.__roi_detector, 'trackRoi', 'RoiDetector.trackRoi')
+            
+    def latencyStats(self):
+        """p50/p95/p99 latencies per stage, see latency.LatencyStats.summary"""
+        if self.__latency_stats is None:
+            return {}
+        return self.__latency_stats.summary()
+        
+    def getParams(self):
+        return self.__params 
+    
+    def setSearchWindow(self, i_enable=True, i_margin=0.5, i_min_ratio=0.6, i_max_ratio=1.6):
+        """Restrict face detection while tracking to a window around the previous roi, 
+           see RoiDetector.setSearchWindow"""
+        if i_enable:
+            self.__roi_detector.setSearchWindow(i_margin, i_min_ratio, i_max_ratio)
+        else:
+            self.__roi_detector.clearSearchWindow()
+    
+    def setGain(self, i_gain):
+        self.__xy_gain = float(i_gain)
+    
+    def detectRoi(self, i_data, i_roi_scale_factor=1.2, i_track=True, i_time=None, i_frame=None):
+        """i_data is an Ipl image or an image_utils.ImagePyramid, see FrameGrabber.pyramid. 
+           i_time is the time the frame was grabbed (FrameGrabber.frameTime), see setMotionModel and setClock.
+           i_frame is the index of the frame in the video (FrameGrabber.frameIndex), see setDetectionCache"""
+        ipl_roi = self.__normaliser.getRoi() 
+        if (ipl_roi is not None) and not(i_track):
+            x = numpy.float(ipl_roi.x) + 0.5*ipl_roi.width
+            y = numpy.float(ipl_roi.y) + 0.5*ipl_roi.height
+            self.__roi_detector.setPrev(x, y, ipl_roi.width, ipl_roi.height)
+            return (0., 0., x,y, ipl_roi.width, ipl_roi.height)
+        if ipl_roi is None:
+            frames = None
+            if i_frame is not None:
+                frames = [i_frame]
+            face_roi = self.__roi_detector.compute([i_data], i_ipl=True, i_frames=frames)
+            if face_roi is None:
+                return (0.0, 0.0, 0.0, 0.0,0.0, 0.0)
+            ipl_image = image_utils.PyramidImage(i_data)
+            face_roi = self.__roi_detector.scaleRoi(face_roi, i_roi_scale_factor, ipl_image.width-1, ipl_image.height-1)
+            ipl_roi = image_utils.Numpy2CvRect( i_face_roi = face_roi)
+            self.__normaliser.setRoi(ipl_roi)
+
+            x = numpy.float(ipl_roi.x) + 0.5*ipl_roi.width
+            y = numpy.float(ipl_roi.y) + 0.5*ipl_roi.height
+            self.__roi_detector.setPrev(x, y, ipl_roi.width, ipl_roi.height)
+        
+            return (0.0, 0.0, x, y, ipl_roi.width, ipl_roi.height)
+        #At this point i_track=True, ipl_roi is not None
+        if self.__scheduler is None:
+            return self.__roi_detector.trackRoi(i_data, i_time=i_time, i_frame=i_frame )
+        return self.__scheduledTrack(i_data, i_time, i_frame)
+    
+    def __scheduledTrack(self, i_data, i_time, i_frame):
+        ipl_image = image_utils.PyramidImage(i_data)
+        #Without a template (e.g. a degenerate roi was dropped) or template estimate (the face 
+        #left the image) the frame becomes a keyframe
+        if (not self.__scheduler.isKeyFrame()) and self.__template_tracker.hasTemplate():
+            t = latency.monotonic()
+            estimate = self.__template_tracker.estimate(ipl_image)
+            if estimate is not None:
+                (face_roi, score) = estimate
+                self.__scheduler.trackFrame(score, latency.monotonic() - t)
+                return self.__roi_detector.filterRoi(face_roi, i_time=i_time)
+        t = latency.monotonic()
+        face_roi = self.__roi_detector.measureRoi(i_data, i_frame)
+        detect_time = latency.monotonic() - t
+        if face_roi is None:
+            self.__scheduler.detectionFailed()
+            return self.__roi_detector.filterRoi(None)
+        drift = None
+        estimate = self.__template_tracker.estimate(ipl_image)
+        if estimate is not None:
+            (min_row, min_col, max_row, max_col) = face_roi
+            (est_min_row, est_min_col, est_max_row, est_max_col) = estimate[0]
+            delta_x = 0.5 * ((min_col + max_col) - (est_min_col + est_max_col))
+            delta_y = 0.5 * ((min_row + max_row) - (est_min_row + est_max_row))
+            drift = numpy.sqrt(delta_x**2 + delta_y**2) / max(max_col - min_col, 1)
+        self.__scheduler.keyFrame(drift, detect_time)
+        self.__template_tracker.setTemplate(ipl_image, face_roi)
+        return self.__roi_detector.filterRoi(face_roi, i_time=i_time)
+ 
+    def update(self, i_ipl_image, i_track=False, i_time=None, i_frame=None):
+        (delta_x, delta_y, x,y,w,h) = self.detectRoi(i_ipl_image,i_track=i_track, i_time=i_time, i_frame=i_frame)
+        return (delta_x, delta_y, x, y,w,h)
+    
+    def setRoi(self, i_roi):
+        self.__normaliser.setRoi(i_roi)
+        self.__roi_detector.setRoi(image_utils.Cv2NumpyRect)
+        
+    def getRoi(self, i_ipl=False):
+        if i_ipl:
+            return self.__normaliser.getRoi()
+        return image_utils.Cv2NumpyRect(self.__normaliser.getRoi())
+    
+    def clearRoi(self):
+        self.__normaliser.clearRoi()
+        self.__template_tracker.clear()
+        if self.__scheduler is not None:
+            self.__scheduler.reset()
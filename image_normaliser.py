@@ -22,6 +22,142 @@
 import opencv as cv
 import image_utils  
 import numpy
+import threading
+import multiprocessing
+import multiprocessing.pool
+import multiprocessing.sharedctypes
+
+# The normaliser and output array of each normalise_batch worker (thread or process)
+g_batch_worker = threading.local()
+# Number of NormalisationPlans kept by a normaliser (e.g., of its own settings and the overrides 
+# of similarityTransform)
+g_max_plans = 4
+
+def PatchMatrix(i_rot_mat, i_roi, i_width, i_height, o_mat):
+    """Compose the affine transform i_rot_mat with the translation of the region i_roi to the 
+       origin and its resize to i_width x i_height (pixel centres are mapped as in cvResize): 
+       cvWarpAffine with o_mat then computes the output patch only"""
+    scale_x = float(i_width) / float(i_roi.width)
+    scale_y = float(i_height) / float(i_roi.height)
+    for (row, scale, offset) in [(0, scale_x, i_roi.x), (1, scale_y, i_roi.y)]:
+        for col in range(0, 2):
+            cv.cvmSet( o_mat, row, col, scale * cv.cvmGet(i_rot_mat, row, col) )
+        translation = scale * (cv.cvmGet(i_rot_mat, row, 2) - float(offset)) + 0.5 * scale - 0.5
+        cv.cvmSet( o_mat, row, 2, translation )
+    return o_mat
+
+def PlanKey(i_params, i_image_size):
+    """The settings a NormalisationPlan is compiled for (see IplImageNormaliser.getParams): 
+       the position of the roi and the affine transform can change between runs"""
+    roi_size = None
+    if i_params['roi'] is not None:
+        roi_size = tuple(i_params['roi'][2:4])
+    return ( i_params['resize_scale'], i_params['filter_size'], bool(i_params['eq']), roi_size, 
+             tuple(i_image_size) )
+
+def AffineParams(i_center, i_scale, i_rot_angle):
+    """The affine transform (center x, center y, scale, angle) of the settings, None if it is the 
+       identity (no warping required)"""
+    if  (abs(i_scale - 1.0) < 1E-6) and ( abs(i_rot_angle) < 1E-6 ):
+        return None
+    return (i_center.x, i_center.y, i_scale, i_rot_angle)
+
+class NormalisationPlan(object):
+    """The steps of IplImageNormaliser.normalise compiled for fixed settings and input image size 
+       (see PlanKey). The plan owns all its intermediate and output images, so running it does not 
+       allocate: the output is overwritten by the next run."""
+    def __init__(self, i_params, i_image_size):
+        self.__key = PlanKey(i_params, i_image_size)
+        (resize_scale, self.__filter_size, self.__equalise_hist, roi_size, image_size) = self.__key
+        if roi_size is None:
+            roi_size = image_size
+        self.__resize = (resize_scale != 1)
+        (w, h) = roi_size
+        if self.__resize:
+            (w, h) = ( int(round( w * resize_scale)), int(round( h * resize_scale)) )
+        self.__size = (w, h)
+        self.__crop = (i_params['roi'] is not None)
+        self.__affine = None #The affine transform __rot_mat was computed for
+        self.__rot_mat = cv.cvCreateMat(2, 3, 5)
+        self.__warp_mat = cv.cvCreateMat(2, 3, 5)
+        #The output before filtering (the input image is returned as is if nothing has to be done)
+        self.__patch = cv.cvCreateImage( cv.cvSize(w, h), 8, 1 )
+        self.__smoothed = None
+        if self.__filter_size > 0:
+            self.__smoothed = cv.cvCreateImage( cv.cvSize(w, h), 8, 1 )
+        self.__cropped_image = None
+        
+    def key(self):
+        return self.__key
+    
+    def matches(self, i_params, i_image_size):
+        return PlanKey(i_params, i_image_size) == self.__key
+    
+    def size(self):
+        """Output (width, height)"""
+        return self.__size
+    
+    def croppedImage(self):
+        """The output of the last run before histogram equalisation and filtering"""
+        return self.__cropped_image
+    
+    def run(self, i_image, i_roi=None, i_affine=None):
+        """Normalise i_image: the size of i_roi has to match the settings the plan was compiled for,
+           i_affine is the affine transform (see AffineParams)"""
+        if i_affine is not None:
+            if i_affine != self.__affine:
+                (center_x, center_y, scale, angle) = i_affine
+                cv.cv2DRotationMatrix( cv.cvPoint2D32f(center_x, center_y), angle, scale, self.__rot_mat )
+                self.__affine = i_affine
+            if i_roi is None:
+                i_roi = cv.cvRect(0, 0, i_image.width, i_image.height)
+            PatchMatrix( self.__rot_mat, i_roi, self.__size[0], self.__size[1], self.__warp_mat )
+            cv.cvWarpAffine( i_image, self.__patch, self.__warp_mat )
+            return self.filter(self.__patch)
+        region = i_image
+        if i_roi is not None:
+            region = cv.cvGetSubRect(i_image, i_roi)
+        if self.__resize:
+            cv.cvResize( region, self.__patch, cv.CV_INTER_LINEAR )
+        elif self.__crop or self.__equalise_hist:
+            cv.cvCopy( region, self.__patch )
+        else:
+            return self.filter(i_image)
+        return self.filter(self.__patch)
+    
+    def runLevel(self, i_level, i_rect):
+        """Normalise the region i_rect (of the output size) of an image pyramid level"""
+        cv.cvCopy( cv.cvGetSubRect(i_level, i_rect), self.__patch )
+        return self.filter(self.__patch)
+    
+    def filter(self, i_image):
+        """Histogram equalisation (in place) and smoothing"""
+        self.__cropped_image = i_image
+        if self.__equalise_hist: 
+            cv.cvEqualizeHist(i_image, i_image)
+        if self.__smoothed is None:
+            return i_image
+        cv.cvSmooth(i_image, self.__smoothed, cv.CV_GAUSSIAN, self.__filter_size)
+        return self.__smoothed
+
+def LoadBatchWorker(i_params, i_output, i_shape):
+    """Pool initialiser of normalise_batch: each worker gets its own normaliser with the settings 
+       i_params (see IplImageNormaliser.getParams) and writes into i_output, a numpy array (threads) 
+       or a shared memory array (processes) of i_shape"""
+    g_batch_worker.normaliser = IplImageNormaliser()
+    g_batch_worker.normaliser.loadParams(i_params)
+    if not isinstance(i_output, numpy.ndarray):
+        i_output = numpy.frombuffer(i_output, dtype=numpy.uint8).reshape(i_shape)
+    g_batch_worker.output = i_output
+
+def NormaliseFrames(i_frames):
+    """Worker of normalise_batch: normalise a list of (index, frame) pairs into the rows index 
+       of the output array, where the frames are Ipl images or numpy arrays"""
+    for (index, frame) in i_frames:
+        if isinstance(frame, numpy.ndarray):
+            frame = image_utils.NumpyIplHeader( numpy.ascontiguousarray(frame) )
+        g_batch_worker.output[index] = image_utils.IplNumpyView( g_batch_worker.normaliser.normalise(frame) )
+    return len(i_frames)
 
 class IplImageNormaliser(object):
     """Do a set of standard preprocessing (normalisation) operations on an Ipl image"""
@@ -31,8 +167,10 @@ class IplImageNormaliser(object):
         self.__filter_size = 0       #Filtering input image - if set to 0 no filtering will be performed
         self.clearRoi()             #Cv Rect specifying region of interest=None for no cropping
         self.__equalise_hist = False #Apply histogram equalisation or not
-        self.__rot_mat = None       #Scaling and rotation affine matrix, set to None if no affine warping is required
+        self.__affine = None        #(center x, center y, scale, angle), None if no affine warping is required
         self.__cropped_image = None
+        self.__plans = {}           #NormalisationPlans by PlanKey, see plan
+        self.__pyramid_levels = False #Crop from the pyramid level at the resize scale, see setPyramidLevels
       
     def clearRoi(self):
         self.__roi = None  
@@ -57,16 +195,40 @@ class IplImageNormaliser(object):
             self.__roi = None
         self.__equalise_hist  = i_eq
         
+    def setPyramidLevels(self, i_pyramid_levels=False):
+        """Crop the region of interest of an image_utils.ImagePyramid from its level at the resize 
+           scale (no affine transform), instead of cropping and resizing its full size frame. The 
+           level is not resized with cvResize and its roi is rounded to the level, so the patches 
+           differ slightly from those of an Ipl image."""
+        self.__pyramid_levels = i_pyramid_levels
+        
     def clearAffine(self):
-        self.__rot_mat = None
+        self.__affine = None
     
     def setAffineTransform(self, i_center, i_scale, i_rot_angle):
         """See open cv documentation of cvWarpAffine"""
-        if  (abs(i_scale - 1.0) < 1E-6) and ( abs(i_rot_angle) < 1E-6 ):
-            self.__rot_mat = None
+        self.__affine = AffineParams(i_center, i_scale, i_rot_angle)
+            
+    def getParams(self):
+        """Return all settings as a dictionary of python types (can be pickled and passed to 
+           another process), see loadParams"""
+        roi = None
+        if self.__roi is not None:
+            roi = (self.__roi.x, self.__roi.y, self.__roi.width, self.__roi.height)
+        return { 'resize_scale' : self.__resize_scale, 'filter_size' : self.__filter_size, 
+                 'eq' : self.__equalise_hist, 'roi' : roi, 'affine' : self.__affine }
+    
+    def loadParams(self, i_params):
+        """Restore the settings returned by getParams"""
+        roi = None
+        if i_params['roi'] is not None:
+            roi = cv.cvRect( *i_params['roi'] )
+        self.setParams( i_params['resize_scale'], i_params['filter_size'], i_params['eq'], roi)
+        if i_params['affine'] is None:
+            self.clearAffine()
         else:
-            self.__rot_mat = cv.cvCreateMat(2,3, 5) #Affine matrix
-            cv.cv2DRotationMatrix( i_center, i_rot_angle, i_scale, self.__rot_mat )
+            (center_x, center_y, scale, angle) = i_params['affine']
+            self.setAffineTransform( cv.cvPoint2D32f(center_x, center_y), scale, angle)
     
     def similarityTransform(self, i_image, i_transform, i_crop=True ):
         """Apply affine transform around center of region of interest, then translate roi"""
@@ -75,19 +237,15 @@ class IplImageNormaliser(object):
         scale = i_transform[2]
         angle = i_transform[3]
         center = cv.cvPoint2D32f( self.__roi.x + self.__roi.width/2,self.__roi.y + self.__roi.height/2 )
-        self.setAffineTransform( center, scale, angle)
-        original_roi = cv.cvRect( self.__roi.x,  self.__roi.y,  self.__roi.width,  self.__roi.height)
-        
+        #The transform is applied without filtering, and without changing the settings
+        params = self.getParams()
+        params['affine'] = AffineParams(center, scale, angle)
+        params['filter_size'] = 0
         if not i_crop:
-            self.__roi = None
+            params['roi'] = None
         else:
-            self.__roi.x = self.__roi.x + int(tx)
-            self.__roi.y = self.__roi.y + int(ty)
-        filter_size = self.__filter_size
-        self.__filter_size = 0
-        o_image =  self.normalise(i_image)
-        self.__filter_size = filter_size
-        self.__roi = cv.cvRect(original_roi.x, original_roi.y, original_roi.width,  original_roi.height)
+            params['roi'] = (self.__roi.x + int(tx), self.__roi.y + int(ty), self.__roi.width, self.__roi.height)
+        o_image = self.__run(image_utils.PyramidImage(i_image), params)
         return  cv.Ipl2NumPy(o_image)
     
     def correctImage(self, i_image, i_transform):
@@ -100,8 +258,9 @@ class IplImageNormaliser(object):
         scale = i_transform[2]
         angle = i_transform[3]
         center = cv.cvPoint2D32f( self.__roi.x + self.__roi.width/2,self.__roi.y + self.__roi.height/2 )
-        self.setAffineTransform( center, scale, angle)
-        o_image =  self.normalise(i_image)
+        params = self.getParams()
+        params['affine'] = AffineParams(center, scale, angle)
+        o_image = self.__run(image_utils.PyramidImage(i_image), params)
         return  cv.Ipl2NumPy(o_image)
     
     def crop(self, i_image):
@@ -111,59 +270,151 @@ class IplImageNormaliser(object):
         return self.__cropped_image
         
     def normalise(self, i_ipl_image):
-        #Do the affine transform
-        if self.__rot_mat == None:
-            warped_image = i_ipl_image
-        else:
-            warped_image = cv.cvCreateImage(cv.cvSize(i_ipl_image.width,i_ipl_image.height), 8, 1)
-            cv.cvWarpAffine(i_ipl_image , warped_image,  self.__rot_mat );
-        #Crop
-        if self.__roi == None:
-            self.__cropped_image = warped_image
-        else:
-            self.crop(warped_image)
-        #Scale
-        if  self.__resize_scale == 1:
-            scaled_image = self.__cropped_image
-        else: 
-            w = int(round( self.__cropped_image.width * self.__resize_scale))
-            h = int(round( self.__cropped_image.height * self.__resize_scale))
-            scaled_image = cv.cvCreateImage(cv.cvSize(w, h), 8, 1)
-            cv.cvResize( self.__cropped_image, scaled_image ,cv.CV_INTER_LINEAR)
-        #Histogram equalisation
-        if self.__equalise_hist: 
-            cv.cvEqualizeHist(scaled_image,scaled_image)
-        #Blur
-        if self.__filter_size == 0: 
-            smoothed_image = scaled_image
-        else: 
-            smoothed_image = cv.cvCreateImage(cv.cvSize(scaled_image.width, scaled_image.height), 8, 1)
-            cv.cvSmooth(scaled_image, smoothed_image, cv.CV_GAUSSIAN, self.__filter_size)
-        return smoothed_image
+        """Normalise an Ipl image or an image_utils.ImagePyramid: the full size frame of a pyramid is 
+           normalised, unless its levels are used (see setPyramidLevels)"""
+        if isinstance(i_ipl_image, image_utils.ImagePyramid):
+            if self.__pyramid_levels and (self.__affine is None) and (self.__roi != None) and (self.__resize_scale < 1):
+                return self.__normaliseLevel(i_ipl_image)
+            i_ipl_image = i_ipl_image.image()
+        #The affine transform, crop and scale are done in one pass (the output is reused by the next call)
+        return self.__run(i_ipl_image, self.getParams())
+    
+    def __run(self, i_ipl_image, i_params):
+        """Normalise with the settings i_params (see getParams)"""
+        plan = self.plan(i_ipl_image.width, i_ipl_image.height, i_params)
+        roi = None
+        if i_params['roi'] is not None:
+            roi = cv.cvRect( *i_params['roi'] )
+        o_image = plan.run(i_ipl_image, roi, i_params['affine'])
+        self.__cropped_image = plan.croppedImage()
+        return o_image
+    
+    def plan(self, i_width, i_height, i_params=None):
+        """Return the NormalisationPlan of the settings i_params (default: the current settings) for 
+           images of i_width x i_height. The last few plans are kept, a plan is only compiled again 
+           if the settings or the size of the roi changed."""
+        if i_params is None:
+            i_params = self.getParams()
+        key = PlanKey(i_params, (i_width, i_height))
+        if not self.__plans.has_key(key):
+            if len(self.__plans) >= g_max_plans:
+                self.__plans = {}
+            self.__plans[key] = NormalisationPlan(i_params, (i_width, i_height))
+        return self.__plans[key]
+    
+    def __normaliseLevel(self, i_pyramid):
+        """Crop the region of interest from the pyramid level at the resize scale: the output 
+           has the same size as the crop resized in normalise"""
+        level = i_pyramid.level(self.__resize_scale)
+        image = i_pyramid.image()
+        scale = float(level.width) / float(image.width)
+        plan = self.plan(image.width, image.height)
+        (w, h) = plan.size()
+        x = min( max( int(round( self.__roi.x * scale )), 0 ), level.width - w )
+        y = min( max( int(round( self.__roi.y * scale )), 0 ), level.height - h )
+        o_image = plan.runLevel( level, cv.cvRect(x, y, w, h) )
+        self.__cropped_image = plan.croppedImage()
+        return o_image
         
-    def normalise_batch(self, i_frame_list):
-        o_data = [self.normalise(i_frame_list[n]) for n in range(0, len(i_frame_list))]
-        return o_data
+    def normalise_batch(self, i_frame_list, i_n_workers=1, i_threads=False, i_numpy=False, i_chunk_size=16):
+        """Normalise a list of Ipl images (or numpy arrays) of the same size, returns the results in 
+           input order as a list of Ipl images, or as one n x rows x cols uint8 array if i_numpy.
+           i_n_workers > 1 (None: one per core) spreads the frames over a pool of workers, each with 
+           its own copy of the settings (getParams). Threads (i_threads) only run in parallel if the 
+           OpenCV bindings release the GIL, use processes otherwise: their results are written into 
+           one array in shared memory. The images of the parallel list are headers of that array."""
+        n_frames = len(i_frame_list)
+        if i_n_workers is None:
+            i_n_workers = multiprocessing.cpu_count()
+        if (i_n_workers <= 1) or (n_frames < 2):
+            frames = [self.__batchFrame(frame) for frame in i_frame_list]
+            if not i_numpy:
+                #normalise can return a reused image: keep a copy of each result
+                return [cv.cvCloneImage(self.normalise(frame)) for frame in frames]
+            if n_frames == 0:
+                return numpy.zeros( (0, 0, 0), dtype=numpy.uint8 )
+            #Copy each result as it is produced, the views of normalise share one buffer
+            first = image_utils.IplNumpyView( self.normalise(frames[0]) )
+            o_data = numpy.empty( (n_frames,) + first.shape, dtype=numpy.uint8 )
+            o_data[0] = first
+            for n in range(1, n_frames):
+                o_data[n] = image_utils.IplNumpyView( self.normalise(frames[n]) )
+            return o_data
+        #The first frame gives the output size
+        first = image_utils.IplNumpyView( self.normalise(self.__batchFrame(i_frame_list[0])) )
+        shape = (n_frames,) + first.shape
+        if i_threads:
+            shared_output = o_data = numpy.empty( shape, dtype=numpy.uint8 )
+            pool = multiprocessing.pool.ThreadPool( i_n_workers, LoadBatchWorker, (self.getParams(), o_data, shape) )
+        else:
+            shared_output = multiprocessing.sharedctypes.RawArray( 'B', int(numpy.prod(shape)) )
+            o_data = numpy.frombuffer(shared_output, dtype=numpy.uint8).reshape(shape)
+            pool = multiprocessing.Pool( i_n_workers, LoadBatchWorker, (self.getParams(), shared_output, shape) )
+        o_data[0] = first
+        chunks = []
+        for start in range(1, n_frames, i_chunk_size):
+            stop = min(start + i_chunk_size, n_frames)
+            frames = [self.__batchFrame(i_frame_list[n], i_threads) for n in range(start, stop)]
+            chunks.append( zip(range(start, stop), frames) )
+        try:
+            pool.map(NormaliseFrames, chunks, 1)
+        finally:
+            pool.close()
+            pool.join()
+        if i_numpy:
+            return o_data
+        return [image_utils.NumpyIplHeader(o_data[n]) for n in range(0, n_frames)]
+    
+    def __batchFrame(self, i_frame, i_ipl=True):
+        """A frame of normalise_batch as an Ipl image, or as a numpy array that can be passed to 
+           a worker process"""
+        if isinstance(i_frame, numpy.ndarray):
+            if i_ipl:
+                return image_utils.NumpyIplHeader( numpy.ascontiguousarray(i_frame) )
+            return i_frame
+        if i_ipl:
+            return i_frame
+        return image_utils.IplNumpyView(i_frame)
 
     def jitter( self, i_image , i_n_examples ):
         """1) Apply various random affine transform to i_image (scale, rotation), 
               where i_n_examples is the number of transformations. The affine transforms happen 
               around the center of the original region of interest. 
            2) Translate roi with various values - crop the image from this region.
-           3) The same normalisation is then applied to all the cropped images, specified by setParams"""
-        
-        #Store transforms applied in format tx ty scale angle
-        o_transforms = numpy.array([0., 0.,  1.,  0.]) 
-        
+           3) The same normalisation is then applied to all the cropped images, specified by setParams
+           Returns (images, transforms): rows x cols x n uint8 images (the first one is the normalised 
+           input image) and the transforms (tx ty scale angle) applied, see jitter_batch"""
+        result = self.jitter_batch(i_image, i_n_examples)
+        if result is None:
+            return None
+        (images, transforms) = result
+        o_data = images.transpose(1, 2, 0)
+        if i_n_examples == 0:
+            return (o_data, numpy.float64(transforms[0,:]))
+        return (o_data, numpy.float64(transforms))
+    
+    def jitter_batch(self, i_image, i_n_examples, o_images=None, o_transforms=None):
+        """Batched version of jitter: all transforms are drawn up front and each of them is applied 
+           with the NormalisationPlan of the settings, i.e., only the scaled region of interest is 
+           warped. 
+           Returns (images, transforms): n x rows x cols uint8 images and a n x 4 float32 table of 
+           the transforms (tx ty scale angle), the first image is the normalised input image.
+           o_images, o_transforms: optional preallocated outputs with at least i_n_examples + 1 
+           rows, the returned arrays are views of their first n rows."""
         if self.__roi == None:
             print "No region of interest - returning input image!"
             return None
         #Always return the normalised verion of the input image
-        image = cv.Ipl2NumPy(self.normalise(i_image))
-        o_data = numpy.tile( None, (image.shape[0], image.shape[1], 1))
-        o_data[:,:,0] =  image
+        image = image_utils.IplNumpyView(self.normalise(i_image))
+        i_image = image_utils.PyramidImage(i_image)
+        if o_images is None:
+            o_images = numpy.empty( (i_n_examples + 1, image.shape[0], image.shape[1]), dtype=numpy.uint8)
+        if o_transforms is None:
+            o_transforms = numpy.empty( (i_n_examples + 1, 4), dtype=numpy.float32)
+        o_images[0,:,:] = image
+        o_transforms[0,:] = [0., 0., 1., 0.]
         if i_n_examples == 0:
-            return ( o_data, o_transforms)
+            return (o_images[0:1], o_transforms[0:1])
         #Rotation point should be around original roi center
         center = cv.cvPoint2D32f( self.__roi.x + self.__roi.width/2,self.__roi.y + self.__roi.height/2 )
         angles = numpy.random.uniform(-30.,30.,i_n_examples)
@@ -179,54 +430,105 @@ class IplImageNormaliser(object):
         valid_x = numpy.hstack([numpy.nonzero( x >= min_x )[0], numpy.nonzero( x < max_x)[0]])
         valid_y = numpy.hstack([numpy.nonzero( y >= min_y )[0], numpy.nonzero( y < max_y)[0]])
         valid_idx = numpy.unique(numpy.hstack([valid_x, valid_y]))
-        original_roi = cv.cvRect( self.__roi.x,  self.__roi.y,  self.__roi.width,  self.__roi.height)
-        if self.__rot_mat == None:
-            original_rot_matrix = None
-        else:
-            original_rot_matrix = cv.cvCloneImage(self.__rot_mat)
-        for index in valid_idx:
-            params = numpy.array([tx[index], ty[index], scales[index], angles[index] ]) 
-            self.setAffineTransform( center, scales[index], angles[index])
-            self.__roi.x = int( x[index] )
-            self.__roi.y = int( y[index] )     
-            image = cv.Ipl2NumPy(self.normalise( i_image ))
-            o_data = numpy.dstack( [o_data, image])
-            o_transforms = numpy.vstack( [o_transforms, params])  
-        #Restore the original region of interest
-        self.__roi.x = original_roi.x
-        self.__roi.y = original_roi.y
-        if original_rot_matrix == None:
-            self.__rot_mat= None
-        else:
-            self.__rot_mat = cv.cvCloneImage(original_rot_matrix)
-        return (o_data, o_transforms)
+        n_valid = len(valid_idx)
+        o_transforms[1:n_valid+1,:] = numpy.vstack( [tx[valid_idx], ty[valid_idx], scales[valid_idx], angles[valid_idx]] ).T
+        plan = self.plan(i_image.width, i_image.height)
+        for n in range(0, n_valid):
+            index = valid_idx[n]
+            roi = cv.cvRect( int(x[index]), int(y[index]), self.__roi.width, self.__roi.height )
+            affine = (center.x, center.y, scales[index], angles[index])
+            o_images[n + 1,:,:] = image_utils.IplNumpyView( plan.run(i_image, roi, affine) )
+        return (o_images[0:n_valid+1], o_transforms[0:n_valid+1])
     
     def jitter_video(self, i_data, i_n_jitter):
-        """Batch processing - jitter a whole video according to region of interest"""    
-        x = None
-        y = None
-        n_jittered = None
-        
-        for i in range(0, i_data.shape[2]):
-            (jittered_images, transforms) = self.jitter(  image_utils.Numpy2Ipl( i_data[:,:,i] ),  i_n_jitter)
-            start_index = 0
-            if  x == None:
-                start_index = 1
-                x = jittered_images[:,:,0].ravel()
-                if i_n_jitter > 0:
-                    y = transforms[0,:]
-                    n_jittered = numpy.array([jittered_images.shape[2]])
+        """Batch processing - jitter a whole video according to region of interest. 
+           Returns (images, transforms, n_jittered): a row with the flattened image of each 
+           jittered example, their transforms (None if i_n_jitter is 0) and the number of examples 
+           of each frame as a column (None if i_n_jitter is 0). The result is kept in memory, 
+           see jitter_frames and jitter_video_files for long videos."""
+        images = []
+        transforms = []
+        n_jittered = []
+        for (batch_images, batch_transforms, batch_n_jittered) in self.jitter_frames(i_data, i_n_jitter):
+            images.append(batch_images.copy())
+            transforms.append(numpy.float64(batch_transforms))
+            n_jittered.append(batch_n_jittered.copy())
+        if len(images) == 0:
+            return (None, None, None)
+        o_images = numpy.vstack(images)
+        if i_n_jitter == 0:
+            return (o_images, None, None)
+        o_transforms = numpy.vstack(transforms)
+        o_n_jittered = numpy.hstack(n_jittered).reshape(-1, 1)
+        return (o_images, o_transforms, o_n_jittered)
+    
+    def jitter_frames(self, i_frames, i_n_jitter, i_batch_frames=64):
+        """Streaming version of jitter_video: i_frames is a rows x cols x n_frames video or an 
+           iterable of 2D frames (e.g. image_utils.VideoFrames). Yields a batch 
+           (images, transforms, n_jittered) per i_batch_frames frames (the last batch can be 
+           smaller), in the layout of jitter_video with n_jittered a 1D array. 
+           The batches are written into the same buffers, i.e., they are only valid until the 
+           next batch is read."""
+        frames = i_frames
+        if isinstance(i_frames, numpy.ndarray):
+            frames = (i_frames[:,:,i] for i in xrange(0, i_frames.shape[2]))
+        max_rows = i_batch_frames * (i_n_jitter + 1)
+        images = None
+        transforms = numpy.empty( (max_rows, 4), dtype=numpy.float32 )
+        n_jittered = numpy.zeros( i_batch_frames, dtype=numpy.int32 )
+        (n_frames, n_rows) = (0, 0)
+        for frame in frames:
+            ipl_image = image_utils.Numpy2Ipl(frame)
+            if images is None:
+                result = self.jitter_batch(ipl_image, i_n_jitter)
+                if result is None:
+                    return
+                images = numpy.empty( (max_rows,) + result[0].shape[1:], dtype=numpy.uint8 )
+                n = result[0].shape[0]
+                images[0:n] = result[0]
+                transforms[0:n] = result[1]
             else:
-                if i_n_jitter > 0:
-                    n_jittered = numpy.vstack([n_jittered, jittered_images.shape[2]])
-                
-            for j in range(start_index, jittered_images.shape[2]):
-                x = numpy.vstack([x, jittered_images[:,:,j].ravel()])
-                if i_n_jitter > 0:
-                    y = numpy.vstack([y, transforms[j]])
-        o_images = x
-        o_transforms = y
-        o_n_jittered = n_jittered
+                result = self.jitter_batch(ipl_image, i_n_jitter, images[n_rows:], transforms[n_rows:])
+                if result is None:
+                    return
+                n = result[0].shape[0]
+            n_jittered[n_frames] = n
+            n_frames += 1
+            n_rows += n
+            if n_frames == i_batch_frames:
+                yield self.__jitterBatch(images, transforms, n_jittered, n_frames, n_rows)
+                (n_frames, n_rows) = (0, 0)
+        if n_frames > 0:
+            yield self.__jitterBatch(images, transforms, n_jittered, n_frames, n_rows)
+            
+    def __jitterBatch(self, i_images, i_transforms, i_n_jittered, i_n_frames, i_n_rows):
+        images = i_images[0:i_n_rows].reshape(i_n_rows, -1)
+        return (images, i_transforms[0:i_n_rows], i_n_jittered[0:i_n_frames])
+    
+    def jitter_video_files(self, i_frames, i_n_jitter, i_images_file, i_transforms_file, i_batch_frames=64):
+        """Jitter a video (see jitter_frames) in bounded memory: the flattened images (uint8) and 
+           transforms (float32) are appended to raw files as the batches are computed, and 
+           memory mapped (read only) once the video is done. 
+           Returns (images, transforms, n_jittered) in the layout of jitter_video, only 
+           n_jittered is kept in memory."""
+        n_jittered = []
+        (n_rows, n_cols) = (0, 0)
+        images_output = open(i_images_file, 'wb')
+        transforms_output = open(i_transforms_file, 'wb')
+        try:
+            for (images, transforms, batch_n_jittered) in self.jitter_frames(i_frames, i_n_jitter, i_batch_frames):
+                images.tofile(images_output)
+                transforms.tofile(transforms_output)
+                n_jittered.append(batch_n_jittered.copy())
+                (n_rows, n_cols) = (n_rows + images.shape[0], images.shape[1])
+        finally:
+            images_output.close()
+            transforms_output.close()
+        if n_rows == 0:
+            return (None, None, None)
+        o_images = numpy.memmap(i_images_file, dtype=numpy.uint8, mode='r', shape=(n_rows, n_cols))
+        o_transforms = numpy.memmap(i_transforms_file, dtype=numpy.float32, mode='r', shape=(n_rows, 4))
+        o_n_jittered = numpy.hstack(n_jittered).reshape(-1, 1)
         return (o_images, o_transforms, o_n_jittered)
 
 if __name__ ==  "__main__":
@@ -18,25 +18,69 @@
 import opencv as cv
 import opencv.highgui
 import numpy
-from PyQt4 import  QtCore, QtGui
-import ImageQt
+import ctypes
+try:
+    from PyQt4 import  QtCore, QtGui
+    import ImageQt
+except ImportError:
+    #Headless use (e.g. batch_tracker.py): the QImage conversions are not available
+    QtCore = QtGui = ImageQt = None
 
 """OpenCV (Ipl), Numpy, Qt and Pil image utility functions"""
-g_color_table = [ ((QtGui.qRgb(i , i,  i) & 0xffffff) - 0x1000000) for  i in range(0,256) ]
+#Gray scale color table for indexed QImages: (qRgb(i, i, i) & 0xffffff) - 0x1000000
+g_color_table = [ (((i << 16) | (i << 8) | i) - 0x1000000) for  i in range(0,256) ]
 
-def IplRGBToGray( i_image ): 
-    """Convert RGB Ipl image to gray scale, returns copy of image if the format is already right."""
-    o_image = cv.cvCreateImage( cv.cvSize( i_image.width, i_image.height ), 8 ,1)
+class IplBufferPool(object):
+    """Reusable destination images for the conversion functions below, keyed by size, depth, 
+       number of channels and a tag naming the conversion step. An image returned from a pool 
+       is overwritten by the next conversion that uses the same key, i.e., it is only valid 
+       until the next frame is processed. Pass a pool with i_pool to opt in."""
+    def __init__(self):
+        self.__images = {}
+        self.__requests = 0
+        self.__allocations = 0
+    
+    def getImage(self, i_width, i_height, i_depth, i_channels, i_tag=''):
+        key = (i_tag, i_width, i_height, i_depth, i_channels)
+        self.__requests += 1
+        if not self.__images.has_key(key):
+            self.__images[key] = cv.cvCreateImage( cv.cvSize(i_width, i_height), i_depth, i_channels)
+            self.__allocations += 1
+        return self.__images[key]
+    
+    def allocations(self):
+        return self.__allocations
+    
+    def stats(self):
+        """The allocation count should stop increasing after the first few frames"""
+        return {'requests' : self.__requests, 'allocations' : self.__allocations, 'buffers' : len(self.__images)}
+    
+    def clear(self):
+        self.__images = {}
+
+def IplCreateImage(i_width, i_height, i_depth, i_channels, i_pool=None, i_tag=''):
+    """Allocate a new image, or fetch a reusable one from i_pool"""
+    if i_pool is None:
+        return cv.cvCreateImage( cv.cvSize( i_width, i_height ), i_depth, i_channels )
+    return i_pool.getImage( i_width, i_height, i_depth, i_channels, i_tag)
+
+def IplRGBToGray( i_image, i_pool=None ): 
+    """Convert RGB Ipl image to gray scale, returns copy of image if the format is already right.
+       When a pool is used an image that is already gray is returned as is."""
     if (i_image.depth == 8) and (i_image.nChannels == 1) :
+        if i_pool is not None:
+            return i_image
+        o_image = cv.cvCreateImage( cv.cvSize( i_image.width, i_image.height ), 8 ,1)
         cv.cvCopy( i_image,  o_image ) 
     else:
+        o_image = IplCreateImage( i_image.width, i_image.height, 8, 1, i_pool, 'gray')
         #cv.cvCvtColor(i_image, o_image , cv.CV_BGR2GRAY )
         cv.highgui.cvConvertImage( i_image, o_image )  
     return o_image
 
-def IplGrayToRGB( i_image ): 
+def IplGrayToRGB( i_image, i_pool=None ): 
     """Convert RGB Ipl image to gray scale, returns copy of image if the format is already right."""
-    o_image = cv.cvCreateImage( cv.cvSize( i_image.width, i_image.height ), 8 ,3)
+    o_image = IplCreateImage( i_image.width, i_image.height, 8, 3, i_pool, 'rgb')
     if (i_image.depth == 8) and (i_image.nChannels == 3) :
         cv.cvCopy( i_image,  o_image ) 
     else:
@@ -44,24 +88,198 @@ def IplGrayToRGB( i_image ):
         cv.highgui.cvConvertImage( i_image, o_image )  
     return o_image
 
+def IplFlip( i_image, i_flip_mode=1, i_pool=None ):
+    """Return a flipped copy of the input image (see cvFlip for the flip modes)"""
+    o_image = IplCreateImage( i_image.width, i_image.height, i_image.depth, i_image.nChannels, i_pool, 'flip')
+    cv.cvFlip( i_image, o_image, i_flip_mode )
+    return o_image
+
+class IplImageStruct(ctypes.Structure):
+    """Memory layout of the C IplImage header, used to share pixel data with numpy"""
+    _fields_ = [ ('nSize', ctypes.c_int), ('ID', ctypes.c_int), ('nChannels', ctypes.c_int),
+                 ('alphaChannel', ctypes.c_int), ('depth', ctypes.c_int),
+                 ('colorModel', ctypes.c_char * 4), ('channelSeq', ctypes.c_char * 4),
+                 ('dataOrder', ctypes.c_int), ('origin', ctypes.c_int), ('align', ctypes.c_int),
+                 ('width', ctypes.c_int), ('height', ctypes.c_int),
+                 ('roi', ctypes.c_void_p), ('maskROI', ctypes.c_void_p), ('imageId', ctypes.c_void_p),
+                 ('tileInfo', ctypes.c_void_p), ('imageSize', ctypes.c_int), 
+                 ('imageData', ctypes.c_void_p), ('widthStep', ctypes.c_int),
+                 ('BorderMode', ctypes.c_int * 4), ('BorderConst', ctypes.c_int * 4),
+                 ('imageDataOrigin', ctypes.c_void_p) ]
+
+#Keys are converted to C ints, signed depths then match the depth field of IplImageStruct
+g_ipl_depths = dict([ (ctypes.c_int(depth).value, dtype) for (depth, dtype) in [
+                      (cv.IPL_DEPTH_8U,  numpy.uint8),
+                      (cv.IPL_DEPTH_8S,  numpy.int8),
+                      (cv.IPL_DEPTH_16U, numpy.uint16),
+                      (cv.IPL_DEPTH_16S, numpy.int16),
+                      (cv.IPL_DEPTH_32S, numpy.int32),
+                      (cv.IPL_DEPTH_32F, numpy.float32),
+                      (cv.IPL_DEPTH_64F, numpy.float64) ] ])
+
+def IplHeader(i_image):
+    """Return the C header of an Ipl image (SWIG proxy) as an IplImageStruct. The struct 
+       does not keep i_image alive."""
+    try:
+        address = long(i_image.this)
+    except (AttributeError, TypeError, ValueError):
+        raise ValueError, "Not an Ipl image created by the opencv bindings"
+    o_header = IplImageStruct.from_address(address)
+    if o_header.nSize != ctypes.sizeof(IplImageStruct):
+        raise ValueError, "Unexpected IplImage header, only IplImage (not CvMat) is supported"
+    return o_header
+
+def IplNumpyView(i_image):
+    """Zero-copy version of cv.Ipl2NumPy: return a numpy array (rows x cols [x channels]) that 
+       shares the pixel data of i_image.
+       Ownership: the array keeps a reference to i_image, so the pixel data are never freed 
+       while the array exists. The array does not own the data though: writing to the array 
+       changes the Ipl image and vice versa. Images that are reused (buffer pools, the frame 
+       ring, cvQueryFrame results) therefore change the contents of earlier views; call .copy() 
+       on the view to keep a frame."""
+    header = IplHeader(i_image)
+    if not g_ipl_depths.has_key(header.depth):
+        raise ValueError, "Unsupported Ipl image depth " + str(header.depth)
+    dtype = numpy.dtype(g_ipl_depths[header.depth])
+    data = (ctypes.c_char * (header.widthStep * header.height)).from_address(header.imageData)
+    data.ipl_image = i_image
+    if header.nChannels == 1:
+        shape = (header.height, header.width)
+        strides = (header.widthStep, dtype.itemsize)
+    else:
+        shape = (header.height, header.width, header.nChannels)
+        strides = (header.widthStep, header.nChannels * dtype.itemsize, dtype.itemsize)
+    return numpy.ndarray(shape, dtype, buffer=data, strides=strides)
+
+def NumpyIplHeader(i_array):
+    """Zero-copy version of cv.NumPy2Ipl: return an Ipl image header that points at the data of 
+       i_array (rows x cols [x channels], each row contiguous in memory). 
+       Ownership: the header keeps a reference to i_array, so the array is never freed while 
+       the header exists. The header does not own the data (imageDataOrigin is left NULL), so 
+       releasing it only frees the header. Opencv functions writing to the header write to 
+       the array."""
+    depths = dict([(numpy.dtype(value), key) for (key, value) in g_ipl_depths.items()])
+    if not depths.has_key(i_array.dtype):
+        raise ValueError, "Unsupported array type " + str(i_array.dtype)
+    if i_array.ndim == 2:
+        channels = 1
+    elif (i_array.ndim == 3) and (i_array.shape[2] <= 4):
+        channels = i_array.shape[2]
+    else:
+        raise ValueError, "Expected a rows x cols [x channels] array"
+    row_step = i_array.itemsize * channels
+    if (i_array.strides[1] != row_step) or ((channels > 1) and (i_array.strides[2] != i_array.itemsize)):
+        raise ValueError, "The rows of the array have to be contiguous in memory"
+    o_image = cv.cvCreateImageHeader( cv.cvSize(i_array.shape[1], i_array.shape[0]), depths[i_array.dtype], channels)
+    header = IplHeader(o_image)
+    header.imageData = i_array.ctypes.data
+    header.widthStep = i_array.strides[0]
+    header.imageSize = i_array.strides[0] * i_array.shape[0]
+    o_image.numpy_array = i_array
+    return o_image
 
 def Ipl2QImage(i_image):
     """ Converts Ipl to QImage that can be displayed in a QLabel
         Only supports displaying grayscale OpenCV and QImages. limited  type checking!"""
+    if (i_image.depth == 8) and (i_image.nChannels == 1):
+        return Numpy2QImage(IplNumpyView(i_image))
     rgb_im = ( cv.Ipl2PIL(i_image)).convert("RGB")
     return ImageQt.ImageQt(rgb_im)
  
 def Ipl2Pil(i_image):    
-    o_flipped_image = cv.cvCreateImage( cv.cvSize( i_image.width, i_image.height ) , i_image.depth, i_image.nChannels )
-    cv.cvFlip( i_image, o_flipped_image )
+    o_flipped_image = IplFlip( i_image, 0 )
     o_pil_image = cv.adaptors.Ipl2Pil( o_flipped_image )
     return o_pil_image 
     
-def IplResize(i_image, i_width, i_height):
-    """Convert RGB to Gray scale and resize to input width and height"""
-    small_image = cv.cvCreateImage( cv.cvSize( i_width, i_height  ) , i_image.depth,  i_image.nChannels )
+def IplResize(i_image, i_width, i_height, i_pool=None):
+    """Resize to input width and height. When a pool is used and the size is already right 
+       the input image is returned as is."""
+    if (i_pool is not None) and (i_image.width == i_width) and (i_image.height == i_height):
+        return i_image
+    small_image = IplCreateImage( i_width, i_height, i_image.depth, i_image.nChannels, i_pool, 'resize')
     cv.cvResize( i_image , small_image )
     return small_image
+
+def IplResizeAndConvert(i_image, i_width, i_height, i_color=False, i_pool=None):
+    """Resize to input width and height and convert to gray scale (unless i_color) in one step: 
+       the conversion is done after resizing, i.e., at the smaller size. Without a pool the 
+       input image is only resized if its size differs from the requested size."""
+    o_image = i_image
+    if (i_image.width != i_width) or (i_image.height != i_height):
+        o_image = IplResize(i_image, i_width, i_height, i_pool)
+    if i_color:
+        return o_image
+    if (o_image is not i_image) and (o_image.depth == 8) and (o_image.nChannels == 1):
+        return o_image
+    return IplRGBToGray(o_image, i_pool)
+    
+class ImagePyramid(object):
+    """The images of one frame at the scales requested by its consumers (face detection, 
+       normalisation, display). Each level is resized from the full size frame the first time 
+       it is requested and then shared until the next frame is set with setImage. The levels 
+       are preallocated images of a buffer pool, i.e., they are only valid until the next frame."""
+    def __init__(self, i_image=None):
+        self.__pool = IplBufferPool()
+        self.__image = None
+        self.__levels = {}
+        self.__generation = 0
+        self.__requests = 0
+        self.__resizes = 0
+        if i_image is not None:
+            self.setImage(i_image)
+        
+    def setImage(self, i_image):
+        """Start a new frame: all levels of the previous frame are invalidated"""
+        self.__image = i_image
+        self.__levels = {}
+        self.__generation += 1
+        
+    def image(self):
+        """The full size frame"""
+        return self.__image
+    
+    def levelSize(self, i_scale):
+        """(width, height) of the level at i_scale, rounded as in ViolaJonesRoi"""
+        width = int(numpy.round( float(self.__image.width) * i_scale ))
+        height = int(numpy.round( float(self.__image.height) * i_scale ))
+        return (max(width, 1), max(height, 1))
+    
+    def level(self, i_scale):
+        """The frame resized by i_scale (<= 1), computed at most once per frame"""
+        self.__requests += 1
+        if i_scale >= 1.0:
+            return self.__image
+        size = self.levelSize(i_scale)
+        if not self.__levels.has_key(size):
+            self.__levels[size] = IplResize(self.__image, size[0], size[1], self.__pool)
+            self.__resizes += 1
+        return self.__levels[size]
+    
+    def generation(self):
+        """The number of frames set so far"""
+        return self.__generation
+    
+    def stats(self):
+        """Level requests and resizes: there should be at most one resize per level and frame"""
+        o_stats = {'requests' : self.__requests, 'resizes' : self.__resizes, 'generation' : self.__generation}
+        o_stats.update( self.__pool.stats() )
+        return o_stats
+    
+def PyramidImage(i_image):
+    """The full size frame of an ImagePyramid, any other image is returned as is"""
+    if isinstance(i_image, ImagePyramid):
+        return i_image.image()
+    return i_image
+
+def PyramidLevel(i_image, i_scale):
+    """The level at i_scale of an ImagePyramid, any other image is resized by i_scale (<= 1)"""
+    if isinstance(i_image, ImagePyramid):
+        return i_image.level(i_scale)
+    if i_scale >= 1.0:
+        return i_image
+    w = int(numpy.round( float( i_image.width ) * i_scale ))
+    h = int(numpy.round( float( i_image.height ) * i_scale ))
+    return IplResize(i_image, w, h)
     
 def Ipl2Formats(i_image, i_formats=['QImage', 'Numpy', 'Pil']):
     """Return a dictionary of converted images as speciefied by input formats (list of strings):
@@ -72,9 +290,11 @@ def Ipl2Formats(i_image, i_formats=['QImage', 'Numpy', 'Pil']):
     return o_images
  
 def Ipl2Format( i_image, i_format):
-    """Return the converted image as specified by i_format (string): possibilities include:"""
+    """Return the converted image as specified by i_format (string): possibilities include:
+       'QImage', 'Numpy' (a view sharing the Ipl data, see IplNumpyView), 'NumpyCopy' and 'Pil'"""
     conversions = { 'QImage' :  Ipl2QImage,  
-                    'Numpy'  :  cv.Ipl2NumPy,
+                    'Numpy'  :  IplNumpyView,
+                    'NumpyCopy' : cv.Ipl2NumPy,
                     'Pil'    :  Ipl2Pil }
     if conversions.has_key(i_format):
         f = conversions[i_format]
@@ -87,15 +307,21 @@ def Ipl2Format( i_image, i_format):
 def Numpy2QImage(i_image):
     """ Converts Numpy to QImage that can be displayed in a QLabel
         Only supports displaying grayscale Numpy and QImages. limited  type checking!"""
-    image = numpy.ubyte(i_image).tostring()
-    o_image = QtGui.QImage( image, i_image.shape[1], i_image.shape[0], i_image.shape[1], 
-                            QtGui.QImage.Format_Indexed8 ).copy()
+    image = numpy.ascontiguousarray(i_image, dtype=numpy.uint8)
+    #The indexed image only borrows the numpy data, the conversion copies it once
+    o_image = QtGui.QImage( image.data, image.shape[1], image.shape[0], image.strides[0], 
+                            QtGui.QImage.Format_Indexed8 )
     o_image.setColorTable( g_color_table )
-    return QtGui.QImage.convertToFormat ( o_image.copy(), QtGui.QImage.Format_RGB32 )
+    return o_image.convertToFormat( QtGui.QImage.Format_RGB32 )
 
 def Numpy2Ipl(i_image):
-    image = numpy.ubyte(i_image)
-    return cv.NumPy2Ipl(image)
+    """Return an Ipl header sharing the data of i_image (see NumpyIplHeader). The array is only 
+       copied if it is not uint8 or if its rows are not contiguous in memory."""
+    image = numpy.asarray(i_image, dtype=numpy.uint8)
+    try:
+        return NumpyIplHeader(image)
+    except ValueError:
+        return NumpyIplHeader(numpy.ascontiguousarray(image))
 
 def Numpy2Formats(i_image, i_formats=['QImage', 'Ipl']):
     """Return a dictionary of converted images as speciefied by input formats (list of strings):
@@ -117,36 +343,151 @@ def Numpy2Format( i_image, i_format):
             raise ValueError, i_format, " format is not supported" 
         return None
 
-def Video2Numpy2D( i_file, i_scale=1.):
-    from frame_grabber import FrameGrabberFile
-    """Return a 3D numpy array from a video file"""
-    frame_grabber = FrameGrabberFile(i_file, i_loop_back = False)
-    o_data = None 
-    nframes = 0
-    w = 0
-    h = 0
-    while True:
-        current_frame = frame_grabber.nextFrame() 
-        if current_frame == None:
-            break
+class NumpyFrameBuffer(object):
+    """Collect equally sized frames into one numpy array in linear time. The array is 
+       preallocated for i_n_frames frames (a hint, e.g., the frame count of a video file, 0 if 
+       unknown) and grows in chunks of at least i_chunk_size frames (doubling its size) if more 
+       frames arrive. The frame index is the last axis if i_frames_last (dstack layout), 
+       otherwise the first axis (vstack layout)."""
+    def __init__(self, i_n_frames=0, i_frames_last=False, i_chunk_size=64):
+        self.__data = None
+        self.__n_frames = 0
+        self.__capacity = max(int(i_n_frames), 1)
+        self.__frames_last = i_frames_last
+        self.__chunk_size = i_chunk_size
+        
+    def __allocate(self, i_capacity, i_frame):
+        if self.__frames_last:
+            data = numpy.empty( i_frame.shape + (i_capacity,), dtype=i_frame.dtype)
+            if self.__data is not None:
+                data[..., :self.__n_frames] = self.__data[..., :self.__n_frames]
         else:
-            current_frame = frame_grabber.currentFrame()
+            data = numpy.empty( (i_capacity,) + i_frame.shape, dtype=i_frame.dtype)
+            if self.__data is not None:
+                data[:self.__n_frames] = self.__data[:self.__n_frames]
+        self.__data = data
+        self.__capacity = i_capacity
+        
+    def append(self, i_frame):
+        if self.__data is None:
+            self.__allocate( self.__capacity, i_frame)
+        elif self.__n_frames == self.__capacity:
+            self.__allocate( self.__capacity + max(self.__capacity, self.__chunk_size), i_frame)
+        if self.__frames_last:
+            self.__data[..., self.__n_frames] = i_frame
+        else:
+            self.__data[self.__n_frames] = i_frame
+        self.__n_frames += 1
+        
+    def nFrames(self):
+        return self.__n_frames
+    
+    def result(self):
+        """Return the collected frames (None if there are none), trimmed to the number of frames"""
+        if self.__data is None:
+            return None
+        if self.__n_frames < self.__capacity:
+            if self.__frames_last:
+                self.__data = self.__data[..., :self.__n_frames].copy()
+            else:
+                self.__data = self.__data[:self.__n_frames].copy()
+            self.__capacity = self.__n_frames
+        return self.__data
+    
+def VideoFrameViews(i_frame_grabber, i_scale=1., i_color=False):
+    """Yield the remaining frames of i_frame_grabber, resized by i_scale and converted to gray 
+       scale (unless i_color), as numpy arrays. No memory is allocated per frame: each array is 
+       a view of a reused buffer and only valid until the next frame is read. The buffer pool 
+       setting of i_frame_grabber is restored when the generator is done or closed."""
+    pool = IplBufferPool()
+    own_pool = i_frame_grabber.bufferPool() is None
+    if own_pool:
+        i_frame_grabber.useBufferPool()
+    try:
+        while True:
+            current_frame = i_frame_grabber.nextFrame() 
+            if current_frame == None:
+                break
             w = int( i_scale * float(current_frame.width) + 0.5 )
             h = int( i_scale * float(current_frame.height) + 0.5 )
-            image = IplResizeAndConvert(current_frame,w,h)
-            image = cv.Ipl2NumPy(image)
-            if o_data == None:
-                o_data = image.reshape(1, w*h)
-            else:
-                o_data = numpy.vstack([o_data, image.reshape(1, w*h)])
-    return (o_data, w, h)
+            yield IplNumpyView( IplResizeAndConvert(current_frame, w, h, i_color, pool) )
+    finally:
+        if own_pool:
+            i_frame_grabber.useBufferPool(False)
+        
+def VideoFrames(i_file, i_scale=1.):
+    """Yield the frames of a video file one at a time as 2D numpy arrays, i.e., the video is 
+       processed in constant memory."""
+    from frame_grabber import FrameGrabberFile
+    frame_grabber = FrameGrabberFile(i_file, i_loop_back = False)
+    try:
+        for image in VideoFrameViews(frame_grabber, i_scale):
+            yield image.copy()
+    finally:
+        #Also when the consumer stops early (the generator is closed)
+        frame_grabber.release()
+    
+def VideoBatches(i_file, i_scale=1., i_batch_size=100, i_flatten=False):
+    """Yield the frames of a video file in batches of i_batch_size frames (the last batch 
+       can be smaller): batch_size x rows x cols arrays, or batch_size x rows*cols arrays 
+       if i_flatten."""
+    from frame_grabber import FrameGrabberFile
+    frame_grabber = FrameGrabberFile(i_file, i_loop_back = False)
+    batch = None
+    n = 0
+    try:
+        for image in VideoFrameViews(frame_grabber, i_scale):
+            if batch is None:
+                batch = numpy.empty( (i_batch_size,) + image.shape, dtype=image.dtype)
+            batch[n] = image
+            n += 1
+            if n == i_batch_size:
+                yield BatchLayout(batch, i_flatten)
+                batch = None
+                n = 0
+        if n > 0:
+            yield BatchLayout(batch[:n], i_flatten)
+    finally:
+        #Also when the consumer stops early (the generator is closed)
+        frame_grabber.release()
+    
+def BatchLayout(i_batch, i_flatten):
+    if i_flatten:
+        return i_batch.reshape(i_batch.shape[0], -1)
+    return i_batch
 
-def Video2IplList(i_file, i_scale=1.0, i_reverse_list=False):
+def Video2Numpy2D( i_file, i_scale=1., i_cache=None):
+    """Return a 2D numpy array from a video file (a flattened frame per row), with the 
+       width and height of the frames: (data, w, h). 
+       If a video_cache.VideoCache is given the frames are memory mapped from the cache."""
     from frame_grabber import FrameGrabberFile
-    """Return a list of video frames in opencv format - first frame first in list if i_reverse_list=False, otherwise first frame is last"""
+    if i_cache is not None:
+        frames = i_cache.load(i_file, i_scale)
+        (n_frames, h, w) = frames.shape
+        return (frames.reshape(n_frames, h*w), w, h)
     frame_grabber = FrameGrabberFile(i_file, i_loop_back = False)
-    o_data = [] 
+    o_data = NumpyFrameBuffer( frame_grabber.frameCount() )
+    w = 0
+    h = 0
+    for image in VideoFrameViews(frame_grabber, i_scale):
+        (h, w) = image.shape
+        o_data.append( image.ravel() )
+    frame_grabber.release()
+    return (o_data.result(), w, h)
 
+def Video2IplList(i_file, i_scale=1.0, i_reverse_list=False, i_cache=None):
+    from frame_grabber import FrameGrabberFile
+    """Return a list of video frames in opencv format - first frame first in list if i_reverse_list=False, otherwise first frame is last.
+       If a video_cache.VideoCache is given the images are headers of the memory mapped frames in the cache."""
+    o_data = [] 
+    if i_cache is not None:
+        frames = i_cache.load(i_file, i_scale)
+        o_data = [NumpyIplHeader(frames[n]) for n in range(0, frames.shape[0])]
+        if i_reverse_list:
+            o_data.reverse()
+        return o_data
+    
+    frame_grabber = FrameGrabberFile(i_file, i_loop_back = False)
     while True:
         current_frame = frame_grabber.nextFrame() 
         if current_frame == None:
@@ -161,44 +502,30 @@ def Video2IplList(i_file, i_scale=1.0, i_reverse_list=False):
     return o_data
     
 
-def Video2Numpy( i_file, i_scale=1. ):
+def Video2Numpy( i_file, i_scale=1., i_cache=None ):
+    """Return a 3D numpy array from a video file (rows x cols x frames).
+       If a video_cache.VideoCache is given the result is a view of the memory mapped frames in the cache."""
     from frame_grabber import FrameGrabberFile
-    """Return a 3D numpy array from a video file"""
+    if i_cache is not None:
+        return numpy.rollaxis( i_cache.load(i_file, i_scale), 0, 3)
     frame_grabber = FrameGrabberFile(i_file, i_loop_back = False)
-    o_data = None 
-    nframes = 0
-    while True:
-        current_frame = frame_grabber.nextFrame() 
-        if current_frame == None:
-            break
-        else:
-            current_frame = frame_grabber.currentFrame()
-            w = int( i_scale * float(current_frame.width) + 0.5 )
-            h = int( i_scale * float(current_frame.height) + 0.5 )
-            image = IplResizeAndConvert(current_frame,w,h)
-            image = cv.Ipl2NumPy(image)
-            if o_data == None:
-                o_data = image 
-            else:
-                o_data = numpy.dstack([o_data, image])
-    return o_data
+    o_data = NumpyFrameBuffer( frame_grabber.frameCount(), i_frames_last=True )
+    for image in VideoFrameViews(frame_grabber, i_scale):
+        o_data.append( image )
+    frame_grabber.release()
+    return o_data.result()
 
 def IplList2Numpy(i_data, i_dstack=True):
-    o_data = None 
+    """Stack a list of Ipl images: rows x cols x frames if i_dstack, otherwise a flattened 
+       image per row"""
+    o_data = NumpyFrameBuffer( len(i_data), i_frames_last=i_dstack )
     for current_frame in i_data:
-        image = cv.Ipl2NumPy(current_frame)
-        if o_data is None:
-            if i_dstack:
-                o_data = image
-            else:
-                o_data = image.flatten()
+        image = IplNumpyView(current_frame)
+        if i_dstack:
+            o_data.append( image )
         else:
-            #Either dstack or flatten and vstack
-            if i_dstack:
-                o_data = numpy.dstack([o_data, image])
-            else:
-                o_data = numpy.vstack([o_data, image.flatten()])
-    return o_data
+            o_data.append( image.ravel() )
+    return o_data.result()
 
 def Numpy2CvRect(i_min_row=None, i_min_col=None, i_max_row=None, i_max_col=None, i_face_roi=None):
     """Convert roi from matrix format (min_row, min_col, max_row, max_col) to opencv rect"""
@@ -0,0 +1,152 @@
+############################################################################
+#    Copyright 2010 Emli-Mari Nel
+#    This file is part of Opengazer-headtracker
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#    See <http://www.gnu.org/licenses/>
+############################################################################
+
+import math
+import time
+import ctypes
+import ctypes.util
+
+"""Low overhead latency instrumentation: fixed-size latency histograms per pipeline stage.
+   Methods are instrumented by shadowing them with a timing wrapper on the instance, switching 
+   the instrumentation off removes the wrapper again, i.e., it costs nothing when off."""
+
+class Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+def MonotonicClock():
+    """Return a function that returns a monotonic time in seconds (time.time as last resort)"""
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno=True)
+        clock_gettime = librt.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(Timespec)]
+    except (OSError, AttributeError):
+        return time.time
+    timespec = Timespec()
+    CLOCK_MONOTONIC = 1
+    def monotonic():
+        clock_gettime(CLOCK_MONOTONIC, ctypes.byref(timespec))
+        return timespec.tv_sec + 1E-9 * timespec.tv_nsec
+    return monotonic
+
+monotonic = MonotonicClock()
+
+class LatencyHistogram(object):
+    """Histogram of latencies (in seconds) with i_n_bins logarithmic bins between i_min and i_max,
+       plus an underflow and overflow bin. Percentiles are accurate to the bin width 
+       ((i_max/i_min)^(1/i_n_bins), i.e., about 6% with the defaults)."""
+    def __init__(self, i_min=1E-5, i_max=10., i_n_bins=240):
+        self.__min = i_min
+        self.__log_min = math.log(i_min)
+        self.__bins_per_log = i_n_bins / (math.log(i_max) - self.__log_min)
+        self.__n_bins = i_n_bins
+        self.reset()
+        
+    def reset(self):
+        self.__counts = [0] * (self.__n_bins + 2)
+        self.__count = 0
+        self.__sum = 0.
+        self.__max = 0.
+        
+    def record(self, i_seconds):
+        if i_seconds <= self.__min:
+            index = 0
+        else:
+            index = min( int((math.log(i_seconds) - self.__log_min) * self.__bins_per_log) + 1, self.__n_bins + 1 )
+        self.__counts[index] += 1
+        self.__count += 1
+        self.__sum += i_seconds
+        if i_seconds > self.__max:
+            self.__max = i_seconds
+            
+    def count(self):
+        return self.__count
+        
+    def percentile(self, i_percentile):
+        """Upper edge of the bin containing the i_percentile (0-100) percentile in seconds"""
+        if self.__count == 0:
+            return 0.
+        rank = 0.01 * i_percentile * self.__count
+        total = 0
+        for index in range(0, len(self.__counts)):
+            total += self.__counts[index]
+            if total >= rank:
+                break
+        if index == 0:
+            return min( self.__min, self.__max )
+        if index > self.__n_bins:
+            return self.__max
+        return min( math.exp(self.__log_min + index / self.__bins_per_log), self.__max )
+    
+    def summary(self):
+        """Statistics in milliseconds"""
+        mean = 0.
+        if self.__count > 0:
+            mean = self.__sum / self.__count
+        return { 'count' : self.__count, 'mean_ms' : 1000. * mean, 'max_ms' : 1000. * self.__max,
+                 'p50_ms' : 1000. * self.percentile(50), 'p95_ms' : 1000. * self.percentile(95),
+                 'p99_ms' : 1000. * self.percentile(99) }
+
+class LatencyStats(object):
+    """A set of named latency histograms, filled by instrumented methods"""
+    def __init__(self):
+        self.__histograms = {}
+        self.__instrumented = []
+        
+    def histogram(self, i_name):
+        if not self.__histograms.has_key(i_name):
+            self.__histograms[i_name] = LatencyHistogram()
+        return self.__histograms[i_name]
+    
+    def instrument(self, i_object, i_method, i_name):
+        """Record the latency of every call to i_object.i_method in the histogram i_name"""
+        method = getattr(i_object, i_method)
+        histogram = self.histogram(i_name)
+        def timedMethod(*args, **kwargs):
+            t = monotonic()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                histogram.record( monotonic() - t )
+        setattr(i_object, i_method, timedMethod)
+        self.__instrumented.append( (i_object, i_method) )
+        
+    def uninstrument(self, i_object=None):
+        """Remove the instrumentation of i_object (of all objects if None)"""
+        instrumented = []
+        for (instance, method) in self.__instrumented:
+            if (i_object is None) or (instance is i_object):
+                delattr(instance, method)
+            else:
+                instrumented.append( (instance, method) )
+        self.__instrumented = instrumented
+        
+    def reset(self):
+        for histogram in self.__histograms.values():
+            histogram.reset()
+    
+    def summary(self):
+        """Dictionary of the statistics (see LatencyHistogram.summary) of each stage"""
+        return dict([ (name, histogram.summary()) for (name, histogram) in self.__histograms.items() ])
+    
+    def report(self):
+        o_lines = ["%-26s %8s %9s %9s %9s %9s" % ("stage", "count", "p50 ms", "p95 ms", "p99 ms", "max ms")]
+        for (name, stats) in sorted(self.summary().items()):
+            o_lines.append( "%-26s %8d %9.2f %9.2f %9.2f %9.2f" % (name, stats['count'], stats['p50_ms'], 
+                            stats['p95_ms'], stats['p99_ms'], stats['max_ms']) )
+        return "\n".join(o_lines)
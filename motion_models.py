@@ -0,0 +1,109 @@
+############################################################################
+#    Copyright 2010 Emli-Mari Nel
+#    This file is part of Opengazer-headtracker
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#    See <http://www.gnu.org/licenses/>
+############################################################################
+
+import numpy
+
+"""Motion models for RoiDetector.filterRoi: a model is updated with the measured state (e.g., 
+   x, y, width, height of the face) and the time of the frame it was measured in, and predicts the 
+   state at a later time, e.g., when the output is shown. All state variables are filtered 
+   independently, vectorised over the last axis of the state."""
+
+class ExponentialModel(object):
+    """The fixed smoothing of RoiDetector: the previous state is weighted with i_smoothing, 
+       there is no prediction"""
+    def __init__(self, i_smoothing=0.9):
+        self.__smoothing = i_smoothing
+        self.__state = None
+        
+    def reset(self, i_state=None):
+        self.__state = None
+        if i_state is not None:
+            self.__state = numpy.array(i_state, dtype=numpy.float64)
+        
+    def update(self, i_measurement, i_time):
+        measurement = numpy.asarray(i_measurement, dtype=numpy.float64)
+        if self.__state is None:
+            self.__state = measurement.copy()
+        else:
+            self.__state = self.__smoothing * self.__state + (1. - self.__smoothing) * measurement
+        
+    def predict(self, i_time):
+        return self.__state.copy()
+    
+class ConstantVelocityModel(object):
+    """Kalman filter with a constant velocity model: each state variable has a position and 
+       velocity with a 2 x 2 covariance, stored as the arrays p_pp, p_pv, p_vv. 
+       i_acceleration_noise: spectral density of the white noise acceleration (pixels^2 / s^3)
+       i_measurement_noise:  variance of the measured positions (pixels^2)
+       i_velocity_noise:     initial variance of the velocities (pixels^2 / s^2)
+       i_max_prediction:     predictions are limited to this many seconds after the last 
+                             measurement, which bounds the overshoot when the motion stops"""
+    def __init__(self, i_acceleration_noise=2000., i_measurement_noise=25., i_velocity_noise=1E4, 
+                 i_max_prediction=0.2):
+        self.__q = i_acceleration_noise
+        self.__r = i_measurement_noise
+        self.__v0 = i_velocity_noise
+        self.__max_prediction = i_max_prediction
+        self.reset()
+        
+    def reset(self, i_state=None):
+        """Restart at i_state with zero velocity (or at the next measurement if None)"""
+        self.__time = None
+        self.__position = None
+        if i_state is None:
+            return
+        self.__position = numpy.array(i_state, dtype=numpy.float64)
+        self.__velocity = numpy.zeros(self.__position.shape)
+        self.__p_pp = numpy.ones(self.__position.shape) * self.__r
+        self.__p_pv = numpy.zeros(self.__position.shape)
+        self.__p_vv = numpy.ones(self.__position.shape) * self.__v0
+        
+    def update(self, i_measurement, i_time):
+        measurement = numpy.asarray(i_measurement, dtype=numpy.float64)
+        if self.__position is None:
+            self.reset(measurement)
+            self.__time = i_time
+            return
+        if self.__time is not None:
+            self.__predictState( max(i_time - self.__time, 0.) )
+        self.__time = i_time
+        #Correction with a measurement of the position only
+        gain_p = self.__p_pp / (self.__p_pp + self.__r)
+        gain_v = self.__p_pv / (self.__p_pp + self.__r)
+        innovation = measurement - self.__position
+        self.__position = self.__position + gain_p * innovation
+        self.__velocity = self.__velocity + gain_v * innovation
+        self.__p_vv = self.__p_vv - gain_v * self.__p_pv
+        self.__p_pp = (1. - gain_p) * self.__p_pp
+        self.__p_pv = (1. - gain_p) * self.__p_pv
+        
+    def __predictState(self, i_dt):
+        q = self.__q
+        self.__position = self.__position + i_dt * self.__velocity
+        self.__p_pp = self.__p_pp + 2. * i_dt * self.__p_pv + i_dt**2 * self.__p_vv + q * i_dt**3 / 3.
+        self.__p_pv = self.__p_pv + i_dt * self.__p_vv + q * i_dt**2 / 2.
+        self.__p_vv = self.__p_vv + q * i_dt
+        
+    def predict(self, i_time):
+        """The extrapolated positions at i_time"""
+        if self.__time is None:
+            return self.__position.copy()
+        horizon = min( max(i_time - self.__time, 0.), self.__max_prediction )
+        return self.__position + horizon * self.__velocity
+    
+    def velocity(self):
+        return self.__velocity.copy()
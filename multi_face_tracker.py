@@ -0,0 +1,130 @@
+############################################################################
+#    Copyright 2010 Emli-Mari Nel
+#    This file is part of Opengazer-headtracker
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#    See <http://www.gnu.org/licenses/>
+############################################################################
+
+from viola_jones_opencv import viola_jones_opencv
+import numpy
+import image_utils
+
+"""Tracking of all faces in view: the detected boxes of each frame are associated with the 
+   existing tracks through their overlaps, all track state is kept in arrays."""
+
+def BoxOverlaps(i_boxes_a, i_boxes_b):
+    """Intersection over union of all pairs of boxes (min_row, min_col, max_row, max_col): 
+       returns a n_a x n_b matrix"""
+    a = numpy.float64(i_boxes_a).reshape(-1, 4)
+    b = numpy.float64(i_boxes_b).reshape(-1, 4)
+    min_rows = numpy.maximum( a[:,0:1], b[:,0] )
+    min_cols = numpy.maximum( a[:,1:2], b[:,1] )
+    max_rows = numpy.minimum( a[:,2:3], b[:,2] )
+    max_cols = numpy.minimum( a[:,3:4], b[:,3] )
+    intersections = numpy.clip(max_rows - min_rows, 0, None) * numpy.clip(max_cols - min_cols, 0, None)
+    areas_a = (a[:,2] - a[:,0]) * (a[:,3] - a[:,1])
+    areas_b = (b[:,2] - b[:,0]) * (b[:,3] - b[:,1])
+    unions = areas_a[:,numpy.newaxis] + areas_b - intersections
+    return intersections / numpy.maximum(unions, 1E-10)
+
+def MatchBoxes(i_boxes_a, i_boxes_b, i_min_overlap=0.3):
+    """Pairs of boxes that are each other's best match and overlap at least i_min_overlap (see 
+       BoxOverlaps). Returns the indices (idx_a, idx_b) of the matched pairs."""
+    overlaps = BoxOverlaps(i_boxes_a, i_boxes_b)
+    if overlaps.size == 0:
+        return (numpy.zeros(0, dtype=numpy.int32), numpy.zeros(0, dtype=numpy.int32))
+    idx_a = numpy.arange(overlaps.shape[0])
+    best_b = numpy.argmax(overlaps, axis=1)
+    best_a = numpy.argmax(overlaps, axis=0)
+    matched = (best_a[best_b] == idx_a) & (overlaps[idx_a, best_b] >= i_min_overlap)
+    return (idx_a[matched], best_b[matched])
+
+def Boxes2States(i_boxes):
+    """Boxes (min_row, min_col, max_row, max_col) to states (x, y, width, height), with (x,y) the centre"""
+    boxes = numpy.float64(i_boxes).reshape(-1, 4)
+    sizes = boxes[:,2:4] - boxes[:,0:2]
+    return numpy.hstack( (boxes[:,1:2] + 0.5*sizes[:,1:2], boxes[:,0:1] + 0.5*sizes[:,0:1], 
+                          sizes[:,1:2], sizes[:,0:1]) )
+ 
+def States2Boxes(i_states):
+    """Inverse of Boxes2States"""
+    states = numpy.float64(i_states).reshape(-1, 4)
+    half_sizes = 0.5 * states[:,2:4]
+    return numpy.hstack( (states[:,1:2] - half_sizes[:,1:2], states[:,0:1] - half_sizes[:,0:1],
+                          states[:,1:2] + half_sizes[:,1:2], states[:,0:1] + half_sizes[:,0:1]) )
+
+class MultiFaceTracker(object):
+    """Tracks all faces detected by viola_jones_opencv (on the image resized by i_scale). Each 
+       track is smoothed like RoiDetector.filterRoi, with weight i_smoothing for the previous state. 
+       A detection starts a new track if it does not overlap (BoxOverlaps) at least i_min_overlap 
+       with a track, a track is dropped after i_max_misses frames without detection."""
+    def __init__(self, i_scale=0.5, i_min_overlap=0.3, i_max_misses=5, i_smoothing=0.9):
+        self.__scale = i_scale
+        self.__min_overlap = i_min_overlap
+        self.__max_misses = i_max_misses
+        self.__smoothing = i_smoothing
+        self.__next_id = 0
+        self.clear()
+        
+    def clear(self):
+        self.__ids = numpy.zeros(0, dtype=numpy.int32)
+        self.__states = numpy.zeros((0, 4))
+        self.__misses = numpy.zeros(0, dtype=numpy.int32)
+        
+    def nTracks(self):
+        return len(self.__ids)
+    
+    def tracks(self):
+        """(ids, states): the track ids and their n x 4 states (x, y, width, height)"""
+        return (self.__ids.copy(), self.__states.copy())
+    
+    def detect(self, i_image):
+        """All faces in an Ipl image or image_utils.ImagePyramid as a n x 4 array of boxes 
+           (min_row, min_col, max_row, max_col) in full size coordinates"""
+        boxes = viola_jones_opencv( image_utils.PyramidLevel(i_image, self.__scale), i_all_faces=True )
+        if self.__scale < 1.0:
+            return numpy.int32(numpy.round( boxes / self.__scale ))
+        return boxes
+    
+    def update(self, i_image):
+        """Detect the faces in i_image and update the tracks, see associate"""
+        return self.associate( self.detect(i_image) )
+        
+    def associate(self, i_boxes):
+        """Update the tracks with the detected boxes (n x 4: min_row, min_col, max_row, max_col). 
+           Returns (ids, states) of the current tracks, where the rows of states are 
+           (delta_x, delta_y, x, y, width, height) as returned by RoiDetector.filterRoi"""
+        measured = Boxes2States(i_boxes)
+        (idx_tracks, idx_boxes) = MatchBoxes( States2Boxes(self.__states), i_boxes, self.__min_overlap )
+        deltas = numpy.zeros( (len(self.__ids), 2) )
+        states = self.__smoothing*self.__states[idx_tracks,:] + (1. - self.__smoothing)*measured[idx_boxes,:]
+        deltas[idx_tracks,:] = states[:,0:2] - self.__states[idx_tracks,0:2]
+        self.__states[idx_tracks,:] = states
+        self.__misses += 1
+        self.__misses[idx_tracks] = 0
+        #New tracks start at the detected boxes
+        new_boxes = numpy.ones(measured.shape[0], dtype=numpy.bool)
+        new_boxes[idx_boxes] = False
+        n_new = numpy.sum(new_boxes)
+        new_ids = numpy.arange(self.__next_id, self.__next_id + n_new, dtype=numpy.int32)
+        self.__next_id += n_new
+        self.__ids = numpy.hstack( (self.__ids, new_ids) )
+        self.__states = numpy.vstack( (self.__states, measured[new_boxes,:]) )
+        self.__misses = numpy.hstack( (self.__misses, numpy.zeros(n_new, dtype=numpy.int32)) )
+        deltas = numpy.vstack( (deltas, numpy.zeros((n_new, 2))) )
+        #Drop lost tracks
+        alive = self.__misses <= self.__max_misses
+        self.__ids = self.__ids[alive]
+        self.__states = self.__states[alive,:]
+        self.__misses = self.__misses[alive]
+        return (self.__ids.copy(), numpy.hstack( (deltas[alive,:], self.__states) ))
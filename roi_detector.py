@@ -19,9 +19,34 @@
 ############################################################################
 
 import opencv as cv
-from viola_jones_opencv import viola_jones_opencv
+from viola_jones_opencv import viola_jones_opencv, ThreadDetector, SharedCascades, g_parameters
 import numpy
+import multiprocessing
 import image_utils as ImageUtils
+import latency
+
+#The detector parameters and cascade of a pool worker, see LoadDetector
+g_worker_param = None
+g_worker_cascade_name = None
+
+def LoadDetector(i_param=None, i_cascade_name=None):
+    """Process pool initialiser: create the detector of the worker (with the cascade parsed
+       before the fork, see SharedCascades) and keep the parameters DetectFaces runs it with"""
+    global g_worker_param, g_worker_cascade_name
+    g_worker_param = i_param
+    g_worker_cascade_name = i_cascade_name
+    ThreadDetector(i_cascade_name)
+
+def DetectFaces(i_frames):
+    """Worker: run the face detector on a list of (frame, image) pairs, where the images are 
+       numpy arrays at the detection scale. Returns the (frame, box) pairs of the frames with a face."""
+    o_boxes = []
+    for (frame, image) in i_frames:
+        vj_box = viola_jones_opencv( ImageUtils.Numpy2Ipl(image), i_param=g_worker_param, 
+                                     i_cascade_name=g_worker_cascade_name )
+        if vj_box is not None:
+            o_boxes.append( (frame, vj_box) )
+    return o_boxes
 
 class RoiDetector(object):
     """This class returns a region of interest from a sequence of images (stored in a 3-dim numpy array)"""
@@ -30,12 +55,64 @@ class RoiDetector(object):
         self.__max_row = 0  
         self.__min_col = 0
         self.__max_col = 0
+        self.__search_window = None
+        self.__motion_model = None
+        self.__output_latency = 0.
+        self.__pipeline_latency = None
+        self.__clock = latency.monotonic
+        
+    def setMotionModel(self, i_model=None, i_output_latency=0.):
+        """Replace the fixed smoothing of filterRoi with a motion model (see motion_models), which 
+           predicts the roi at the time the output is used: i_output_latency seconds after 
+           filterRoi returns (e.g., the display latency). None restores the fixed smoothing."""
+        self.__motion_model = i_model
+        self.__output_latency = i_output_latency
+        self.__pipeline_latency = None
+        if i_model is not None:
+            i_model.reset()
+    
+    def pipelineLatency(self):
+        """Average time (s) between the capture of a frame and the prediction of its roi, None 
+           without a motion model or frame times"""
+        return self.__pipeline_latency
+    
+    def setClock(self, i_clock=None):
+        """The clock of the frame times passed to filterRoi, a function returning the current time
+           in seconds (latency.monotonic if None). E.g., the position in the video when processing
+           a video file: the predictions then only depend on the video."""
+        if i_clock is None:
+            i_clock = latency.monotonic
+        self.__clock = i_clock
+        self.__pipeline_latency = None
+        
+    def setSearchWindow(self, i_margin=0.5, i_min_ratio=0.6, i_max_ratio=1.6):
+        """Let trackRoi search for the face only inside the previous roi (see setPrev), enlarged 
+           by i_margin times its width and height on each side. The face size has to be between 
+           i_min_ratio and i_max_ratio times the previous width. If no face is found inside the 
+           window the whole frame is searched."""
+        self.__search_window = (i_margin, i_min_ratio, i_max_ratio)
+        
+    def clearSearchWindow(self):
+        self.__search_window = None
+        
+    def searchWindow(self, i_max_width, i_max_height):
+        """Return the search window (Cv rect) around the previous roi, clipped to the image"""
+        (margin, min_ratio, max_ratio) = self.__search_window
+        half_width = (0.5 + margin) * self.__prev_width
+        half_height = (0.5 + margin) * self.__prev_height
+        min_x = max( int(self.__prev_x - half_width), 0 )
+        min_y = max( int(self.__prev_y - half_height), 0 )
+        max_x = min( int(numpy.ceil(self.__prev_x + half_width)), i_max_width )
+        max_y = min( int(numpy.ceil(self.__prev_y + half_height)), i_max_height )
+        return cv.cvRect( min_x, min_y, max_x - min_x, max_y - min_y )
         
     def setPrev(self, x,y, width, height):
         self.__prev_x = x
         self.__prev_y = y
         self.__prev_width = width
         self.__prev_height = height
+        if self.__motion_model is not None:
+            self.__motion_model.reset( [x, y, width, height] )
        
     def compute( self, i_images ):
         return (self.__min_row, self.__min_col, self.__max_row, self.__max_col )
@@ -73,17 +150,45 @@ class RoiDetector(object):
         (min_row, min_col, max_row, max_col) = ImageUtils.Cv2NumpyRect(ipl_roi)
         return (min_row, min_col, max_row, max_col)
          
-    def trackRoi(self, i_ipl_image, i_adapt_window_size=True):
-     
-        face_roi = self.compute([i_ipl_image], i_ipl=True)
-        if face_roi is None:
+    def computeWindow(self, i_ipl_image, i_window, i_min_size, i_max_size):
+        """Detect a face of i_min_size to i_max_size pixels inside i_window (Cv rect) only, returns 
+           None if no face was found - no detection is done by the base class"""
+        return None
+    
+    def measureRoi(self, i_ipl_image, i_frame=None):
+        """Detect the face in a frame for tracking: inside the search window if enabled, 
+           otherwise (or if that fails) in the whole frame. i_frame: index of the frame in the 
+           video, with which whole frame detections can be cached (see ViolaJonesRoi.compute)"""
+        if self.__search_window is not None:
+            (margin, min_ratio, max_ratio) = self.__search_window
+            ipl_image = ImageUtils.PyramidImage(i_ipl_image)
+            window = self.searchWindow(ipl_image.width, ipl_image.height)
+            if (window.width > 0) and (window.height > 0):
+                face_roi = self.computeWindow(i_ipl_image, window, min_ratio * self.__prev_width, 
+                                              max_ratio * self.__prev_width)
+                if face_roi is not None:
+                    return face_roi
+        if i_frame is None:
+            return self.compute([i_ipl_image], i_ipl=True)
+        return self.compute([i_ipl_image], i_ipl=True, i_frames=[i_frame])
+        
+    def trackRoi(self, i_ipl_image, i_adapt_window_size=True, i_time=None, i_frame=None):
+        return self.filterRoi( self.measureRoi(i_ipl_image, i_frame), i_adapt_window_size, i_time )
+        
+    def filterRoi(self, i_face_roi, i_adapt_window_size=True, i_time=None):
+        """Smooth the detected face roi (None if no face was found) with the previous roi. 
+           i_time: the capture time of the frame (latency.monotonic), used by the motion model"""
+        if i_face_roi is None:
             return (0.0,  0.0, self.__prev_x, self.__prev_y, self.__prev_width, self.__prev_height)
         
-        roi = ImageUtils.Numpy2CvRect( i_face_roi=face_roi )
-        x = 0.9*self.__prev_x + 0.1*( roi.x + 0.5*roi.width)
-        y = 0.9*self.__prev_y + 0.1*( roi.y + 0.5*roi.height)
-        w = 0.9*self.__prev_width + 0.1*roi.width
-        h = 0.9*self.__prev_height + 0.1*roi.height
+        roi = ImageUtils.Numpy2CvRect( i_face_roi=i_face_roi )
+        if self.__motion_model is None:
+            x = 0.9*self.__prev_x + 0.1*( roi.x + 0.5*roi.width)
+            y = 0.9*self.__prev_y + 0.1*( roi.y + 0.5*roi.height)
+            w = 0.9*self.__prev_width + 0.1*roi.width
+            h = 0.9*self.__prev_height + 0.1*roi.height
+        else:
+            (x, y, w, h) = self.__predictRoi(roi, i_time)
     
         o_x = x - self.__prev_x
         o_y = y - self.__prev_y
@@ -94,54 +199,171 @@ class RoiDetector(object):
             self.__prev_width = w
             self.__prev_height = h
         return (o_x, o_y, self.__prev_x, self.__prev_y, self.__prev_width, self.__prev_height)
+    
+    def __predictRoi(self, i_roi, i_time):
+        """Update the motion model with the measured roi and predict it at output time"""
+        now = self.__clock()
+        if i_time is None:
+            i_time = now
+        elif self.__pipeline_latency is None:
+            self.__pipeline_latency = now - i_time
+        else:
+            self.__pipeline_latency = 0.9*self.__pipeline_latency + 0.1*(now - i_time)
+        measurement = [i_roi.x + 0.5*i_roi.width, i_roi.y + 0.5*i_roi.height, i_roi.width, i_roi.height]
+        self.__motion_model.update(measurement, i_time)
+        return tuple( self.__motion_model.predict(now + self.__output_latency) )
  
 class ViolaJonesRoi( RoiDetector):
-    """The first face in the sequence of numpy arrays is returned"""
-    def __init__(self, i_scale=1.0):
+    """The first face in the sequence of numpy arrays is returned. 
+       With i_n_processes > 1 (None: one per cpu) compute spreads the frames of a clip over a 
+       process pool, which is kept until close is called; the result is the same as with one process.
+       i_method, i_param and i_cascade_name select the detector setup as in viola_jones_opencv."""
+    def __init__(self, i_scale=1.0, i_n_processes=1, i_method='webcam', i_param=None, i_cascade_name=None):
         RoiDetector.__init__(self)
+        if i_param is None:
+            i_param = g_parameters[i_method]
+        self.__param = dict(i_param)
+        self.__cascade_name = i_cascade_name
         self.__frame = -1
         self.__n_rows = 0
         self.__n_cols = 0
         self.__scale = i_scale
+        self.__pool = None
+        self.__detection_cache = None
+        self.__window_image = None #Reused image of the search window, see computeWindow
+        self.setProcesses(i_n_processes)
         
-    def compute(self, i_data, i_ipl=False):
-        frame = 0
-        self.__frame = -1
-        max_dist = 0
+    def setDetectionCache(self, i_cache=None):
+        """Reuse the detections stored in i_cache (a detection_cache.DetectionCache of the video 
+           being processed, made with the scale of this detector) for the frames of which the 
+           video frame index is passed to compute. The cache is keyed on the parameters and 
+           cascade of this detector."""
+        if i_cache is not None:
+            i_cache.setDetector(self.__param, self.__cascade_name)
+        self.__detection_cache = i_cache
+        
+    def params(self):
+        return dict(self.__param)
+    
+    def cascadeName(self):
+        return self.__cascade_name
+        
+    def detectionCache(self):
+        return self.__detection_cache
+        
+    def setProcesses(self, i_n_processes=1):
+        self.close()
+        if i_n_processes is None:
+            i_n_processes = multiprocessing.cpu_count()
+        self.__n_processes = max(i_n_processes, 1)
         
+    def close(self):
+        """Terminate the process pool (if any)"""
+        if self.__pool is not None:
+            self.__pool.terminate()
+            self.__pool.join()
+            self.__pool = None
+        
+    def compute(self, i_data, i_ipl=False, i_frames=None):
+        """i_frames: the indices in the video of the frames in i_data. With a detection cache 
+           (see setDetectionCache) only the frames that are not in the cache are detected."""
+        self.__frame = -1
         if i_ipl:
             nframes = len(i_data)
         else:
             nframes = i_data.shape[2]
+        frames = range(0, nframes)
+        cached = []
+        cache = self.__detection_cache
+        if (cache is not None) and (i_frames is not None):
+            (frames, cached) = self.__cachedDetections(i_data, i_ipl, i_frames)
+        if (self.__n_processes > 1) and (len(frames) > 1):
+            detections = self.__detectFramesParallel(i_data, i_ipl, frames)
+        else:
+            detections = self.__detectFrames(i_data, i_ipl, frames)
+        if (cache is not None) and (i_frames is not None):
+            boxes = dict( [(frame, vj_box) for (frame, vj_box, size) in detections] )
+            for frame in frames:
+                cache.store(i_frames[frame], boxes.get(frame))
+            #Same order as without cache
+            detections = sorted(cached + detections, key=lambda detection: detection[0])
+        return self.__selectRoi(detections)
+    
+    def __cachedDetections(self, i_data, i_ipl, i_frames):
+        """Returns (frames, detections): the frames that are not cached, and the cached detections"""
+        o_frames = []
+        o_detections = []
+        for frame in range(0, len(i_frames)):
+            if not self.__detection_cache.isCached(i_frames[frame]):
+                o_frames.append(frame)
+                continue
+            vj_box = self.__detection_cache.box(i_frames[frame])
+            if vj_box is not None:
+                ipl_image = ImageUtils.PyramidImage( self.__frameImage(i_data, i_ipl, frame) )
+                o_detections.append( (frame, vj_box, (ipl_image.height, ipl_image.width)) )
+        return (o_frames, o_detections)
+    
+    def __frameImage(self, i_data, i_ipl, i_frame):
+        if i_ipl:
+            #Ipl images or ImagePyramids (the detection level is then shared with other users)
+            return i_data[i_frame]
+        return ImageUtils.Numpy2Ipl(i_data[:,:,i_frame])
+    
+    def __detectFrames(self, i_data, i_ipl, i_frames):
+        """Detect the faces in the frames i_frames (indices in i_data). 
+           Returns a list of (frame, box, (n_rows, n_cols)) in frame order"""
+        o_detections = []
+        for frame in i_frames:
+            image = self.__frameImage(i_data, i_ipl, frame)
+            ipl_image = ImageUtils.PyramidImage(image)
+            vj_box = viola_jones_opencv( ImageUtils.PyramidLevel(image, self.__scale), i_param=self.__param, 
+                                         i_cascade_name=self.__cascade_name )
+            if vj_box is not None:
+                o_detections.append( (frame, vj_box, (ipl_image.height, ipl_image.width)) )
+        return o_detections
+    
+    def __detectFramesParallel(self, i_data, i_ipl, i_frames, i_chunk_size=16):
+        """The frames are resized here and sent to the workers in chunks, a few chunks per 
+           worker at a time to bound the memory used by the queued frames"""
+        if self.__pool is None:
+            #The workers inherit the parsed cascade instead of parsing the xml file each
+            SharedCascades(self.__cascade_name).load()
+            self.__pool = multiprocessing.Pool( self.__n_processes, LoadDetector, 
+                                                (self.__param, self.__cascade_name) )
+        n_batch = 4 * self.__n_processes * i_chunk_size
+        n_frames = len(i_frames)
+        sizes = {}
+        o_detections = []
+        for batch_start in range(0, n_frames, n_batch):
+            chunks = []
+            for chunk_start in range(batch_start, min(batch_start + n_batch, n_frames), i_chunk_size):
+                chunk = []
+                for frame in i_frames[chunk_start:min(chunk_start + i_chunk_size, n_frames)]:
+                    image = self.__frameImage(i_data, i_ipl, frame)
+                    ipl_image = ImageUtils.PyramidImage(image)
+                    sizes[frame] = (ipl_image.height, ipl_image.width)
+                    level = ImageUtils.PyramidLevel(image, self.__scale)
+                    chunk.append( (frame, numpy.array(ImageUtils.IplNumpyView(level))) )
+                chunks.append(chunk)
+            for boxes in self.__pool.map(DetectFaces, chunks, 1):
+                o_detections.extend( [(frame, vj_box, sizes[frame]) for (frame, vj_box) in boxes] )
+        return o_detections
+        
+    def __selectRoi(self, i_detections):
+        """Choose the box at the 80th percentile of the sizes of the detected boxes"""
         list_of_roi = []
         list_of_frames = []
         list_of_sizes = []
-        
-        for frame in range(0, nframes):
-            if i_ipl:
-                ipl_image = i_data[frame]
-            else:
-                ipl_image = cv.NumPy2Ipl(i_data[:,:,frame])
-                
-            if self.__scale < 1.0:
-                w = numpy.int(numpy.round( float( ipl_image.width ) * self.__scale ))
-                h = numpy.int(numpy.round( float( ipl_image.height ) * self.__scale ))
-                small_image = cv.cvCreateImage( cv.cvSize( w, h  ) , ipl_image.depth, ipl_image.nChannels )
-                cv.cvResize( ipl_image , small_image )
-                vj_box = viola_jones_opencv(small_image)
-            else:
-                vj_box = viola_jones_opencv(ipl_image)
-
-            if vj_box is not None:
-                (min_row, min_col, max_row, max_col) = vj_box
-                w = max_col - min_col
-                h = max_row - min_row
-                dist = w*w + h*h       
-                list_of_roi.append(vj_box)
-                list_of_frames.append(frame)
-                list_of_sizes.append(dist)
-                self.__n_rows = ipl_image.height 
-                self.__n_cols = ipl_image.width
+        for (frame, vj_box, (n_rows, n_cols)) in i_detections:
+            (min_row, min_col, max_row, max_col) = vj_box
+            w = max_col - min_col
+            h = max_row - min_row
+            dist = w*w + h*h       
+            list_of_roi.append(vj_box)
+            list_of_frames.append(frame)
+            list_of_sizes.append(dist)
+            self.__n_rows = n_rows 
+            self.__n_cols = n_cols
         #Choose a percentile of the sorted list
         nboxes = len(list_of_sizes)
         if nboxes == 0:
@@ -170,6 +392,67 @@ class ViolaJonesRoi( RoiDetector):
         self.setRoi(vj_box)
         return self.getRoi()
         
+    def computeWindow(self, i_ipl_image, i_window, i_min_size, i_max_size):
+        """Only the search window is resized and searched, with the face size limits derived 
+           from the previous face instead of the relative min_size of viola_jones_opencv. 
+           For an ImagePyramid the window is copied from its detection level instead."""
+        if isinstance(i_ipl_image, ImageUtils.ImagePyramid):
+            return self.__computePyramidWindow(i_ipl_image, i_window, i_min_size, i_max_size)
+        w = max( numpy.int(numpy.round( float( i_window.width ) * self.__scale )), 1 )
+        h = max( numpy.int(numpy.round( float( i_window.height ) * self.__scale )), 1 )
+        small_image = self.__windowImage( w, h, i_ipl_image.depth, i_ipl_image.nChannels )
+        cv.cvSetImageROI( i_ipl_image, i_window )
+        try:
+            cv.cvResize( i_ipl_image , small_image )
+        finally:
+            cv.cvResetImageROI( i_ipl_image )
+        vj_box = viola_jones_opencv(small_image, i_param=self.__param, i_min_size=i_min_size * self.__scale, 
+                                    i_max_size=i_max_size * self.__scale, i_cascade_name=self.__cascade_name)
+        if vj_box is None:
+            return None
+        (min_row, min_col, max_row, max_col) = vj_box
+        scale = float(w) / float(i_window.width)
+        min_row  =  i_window.y + numpy.int(numpy.round( float(min_row) / scale ))
+        min_col  =  i_window.x + numpy.int(numpy.round( float(min_col) / scale ))
+        max_row  =  i_window.y + numpy.int(numpy.round( float(max_row) / scale ))
+        max_col  =  i_window.x + numpy.int(numpy.round( float(max_col) / scale ))
+        self.setRoi( (min_row, min_col, max_row, max_col) )
+        return self.getRoi()
+        
+    def __computePyramidWindow(self, i_pyramid, i_window, i_min_size, i_max_size):
+        level = i_pyramid.level(self.__scale)
+        scale = float(level.width) / float(i_pyramid.image().width)
+        x = min( numpy.int(numpy.round( i_window.x * scale )), level.width - 1 )
+        y = min( numpy.int(numpy.round( i_window.y * scale )), level.height - 1 )
+        w = min( max( numpy.int(numpy.round( i_window.width * scale )), 1 ), level.width - x )
+        h = min( max( numpy.int(numpy.round( i_window.height * scale )), 1 ), level.height - y )
+        small_image = self.__windowImage( w, h, level.depth, level.nChannels )
+        cv.cvSetImageROI( level, cv.cvRect(x, y, w, h) )
+        try:
+            cv.cvCopy( level , small_image )
+        finally:
+            cv.cvResetImageROI( level )
+        vj_box = viola_jones_opencv(small_image, i_param=self.__param, i_min_size=i_min_size * scale, 
+                                    i_max_size=i_max_size * scale, i_cascade_name=self.__cascade_name)
+        if vj_box is None:
+            return None
+        (min_row, min_col, max_row, max_col) = vj_box
+        min_row  =  numpy.int(numpy.round( float(y + min_row) / scale ))
+        min_col  =  numpy.int(numpy.round( float(x + min_col) / scale ))
+        max_row  =  numpy.int(numpy.round( float(y + max_row) / scale ))
+        max_col  =  numpy.int(numpy.round( float(x + max_col) / scale ))
+        self.setRoi( (min_row, min_col, max_row, max_col) )
+        return self.getRoi()
+        
+    def __windowImage(self, i_width, i_height, i_depth, i_channels):
+        """The image the search window is copied into, only allocated again when its size changes 
+           (the window follows the slowly changing face size)"""
+        image = self.__window_image
+        if (image is None) or ((image.width, image.height, image.depth, image.nChannels) != 
+                               (i_width, i_height, i_depth, i_channels)):
+            self.__window_image = cv.cvCreateImage( cv.cvSize(i_width, i_height), i_depth, i_channels )
+        return self.__window_image
+        
     def getDetectedFrame(self):
         return self.__frame
     
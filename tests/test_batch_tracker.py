@@ -0,0 +1,80 @@
+############################################################################
+#    Copyright 2010 Emli-Mari Nel
+#    This file is part of Opengazer-headtracker
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#    See <http://www.gnu.org/licenses/>
+############################################################################
+
+"""Batch tracking with a motion model only depends on the video: tracking the same clip twice
+   gives the same head positions. Usage: python tests/test_batch_tracker.py"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy
+
+my_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(my_path))
+sys.path.insert(0, os.path.join(os.path.dirname(my_path), 'benchmarks'))
+
+import motion_models
+import batch_tracker
+from head_tracker import HeadTracker
+from roi_detector import RoiDetector
+from bench_pipeline import makeClip
+
+class TestVideoClock(unittest.TestCase):
+    def setUp(self):
+        self.__dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.__dir)
+
+    def testFilterRoi(self):
+        """The roi of a face moving at constant speed, filtered twice with a video clock"""
+        outputs = []
+        for run in range(0, 2):
+            video_time = [0.]
+            detector = RoiDetector()
+            detector.setMotionModel( motion_models.ConstantVelocityModel(), 0.05 )
+            detector.setClock( lambda: video_time[0] )
+            detector.setPrev(100., 80., 60., 60.)
+            output = []
+            for frame in range(0, 30):
+                video_time[0] = frame / 30.
+                min_col = 70 + 2 * frame
+                output.append( detector.filterRoi( (50, min_col, 110, min_col + 60), i_time=video_time[0] ) )
+            #No processing delay in video time
+            self.assertEqual(detector.pipelineLatency(), 0.)
+            outputs.append( numpy.array(output) )
+        self.assertTrue( numpy.all(outputs[0] == outputs[1]) )
+        #Predicted 50ms ahead of the last measurement, not the 0.2s prediction limit
+        self.assertTrue( abs(outputs[0][-1, 2] - (100. + 2 * 29 + 0.05 * 60.)) < 2. )
+
+    def testTrackVideoTwice(self):
+        clip = os.path.join(self.__dir, 'clip.avi')
+        makeClip(clip, 30)
+        head_tracker = HeadTracker()
+        head_tracker.setMotionModel( motion_models.ConstantVelocityModel(), 0.05 )
+        (results_1, stats_1) = batch_tracker.trackVideo(clip, head_tracker)
+        (results_2, stats_2) = batch_tracker.trackVideo(clip, head_tracker)
+        self.assertEqual(stats_1['n_frames'], 30)
+        self.assertEqual(stats_2['n_frames'], 30)
+        x = batch_tracker.g_fields.index('x')
+        y = batch_tracker.g_fields.index('y')
+        self.assertTrue( numpy.all(results_1[:, x:y+1] == results_2[:, x:y+1]) )
+
+if __name__ == "__main__":
+    unittest.main()
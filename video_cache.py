@@ -0,0 +1,123 @@
+############################################################################
+#    Copyright 2010 Emli-Mari Nel
+#    This file is part of Opengazer-headtracker
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#    See <http://www.gnu.org/licenses/>
+############################################################################
+
+import os
+import hashlib
+import json
+import numpy
+import image_utils
+
+"""Cache of decoded video frames: a video is decoded once into a raw uint8 file on disk, 
+   which is memory mapped on later runs (no decoding and no loading of the whole video in RAM)"""
+
+class VideoCache(object):
+    """Each cached video consists of two files in the cache directory, named after a key 
+       derived from the absolute path, modification time and size of the video file, the scale 
+       and the colour mode:
+         <key>.frames: the decoded frames (n_frames x rows x cols [x 3], uint8)
+         <key>.index:  the frame index (number of frames, frame shape, source file)
+       The index is written last. A cache entry without index, or of which the size of the frames
+       file does not match the index (e.g., after a crash between writing both files), is 
+       incomplete and decoded again."""
+    def __init__(self, i_cache_dir=None):
+        if i_cache_dir is None:
+            i_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'headtracker')
+        self.__cache_dir = i_cache_dir
+        
+    def cacheDir(self):
+        return self.__cache_dir
+    
+    def key(self, i_file, i_scale=1., i_color=False):
+        file_name = os.path.abspath(i_file)
+        stat = os.stat(file_name)
+        key = "%s|%r|%d|%r|%d" % (file_name, stat.st_mtime, stat.st_size, float(i_scale), int(i_color))
+        return hashlib.sha1(key).hexdigest()
+    
+    def paths(self, i_file, i_scale=1., i_color=False):
+        """Return the (frames, index) file names of a video"""
+        path = os.path.join(self.__cache_dir, self.key(i_file, i_scale, i_color))
+        return (path + '.frames', path + '.index')
+    
+    def isCached(self, i_file, i_scale=1., i_color=False):
+        (frames_file, index_file) = self.paths(i_file, i_scale, i_color)
+        return self.__index(frames_file, index_file) is not None
+    
+    def __index(self, i_frames_file, i_index_file):
+        """The index of a complete cache entry, None if the entry is missing or incomplete"""
+        if not (os.path.exists(i_index_file) and os.path.exists(i_frames_file)):
+            return None
+        try:
+            with open(i_index_file) as input:
+                index = json.load(input)
+            frame_size = int(numpy.prod(index['frame_shape']))
+            if os.path.getsize(i_frames_file) != index['n_frames'] * frame_size:
+                return None
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None
+        return index
+    
+    def load(self, i_file, i_scale=1., i_color=False):
+        """Return the frames of a video (n_frames x rows x cols [x 3]) memory mapped from the 
+           cache, the video is decoded first if it is not in the cache. The frames are mapped 
+           copy-on-write: writing to them never changes the cache."""
+        (frames_file, index_file) = self.paths(i_file, i_scale, i_color)
+        index = self.__index(frames_file, index_file)
+        if index is None:
+            self.decode(i_file, i_scale, i_color)
+            with open(index_file) as input:
+                index = json.load(input)
+        shape = tuple([index['n_frames']] + index['frame_shape'])
+        if index['n_frames'] == 0:
+            return numpy.zeros(shape, dtype=numpy.uint8)
+        return numpy.memmap(frames_file, dtype=numpy.uint8, mode='c', shape=shape)
+    
+    def decode(self, i_file, i_scale=1., i_color=False):
+        """Decode a video into the cache, frames are written as they are decoded (constant memory)"""
+        from frame_grabber import FrameGrabberFile
+        if not os.path.isdir(self.__cache_dir):
+            os.makedirs(self.__cache_dir)
+        (frames_file, index_file) = self.paths(i_file, i_scale, i_color)
+        frame_grabber = FrameGrabberFile(i_file, i_loop_back = False, i_color=i_color)
+        n_frames = 0
+        frame_shape = []
+        #Per process temporary files: processes decoding the same video do not write into each other's files
+        tmp_suffix = '.tmp%d' % os.getpid()
+        output = open(frames_file + tmp_suffix, 'wb')
+        try:
+            for image in image_utils.VideoFrameViews(frame_grabber, i_scale, i_color):
+                numpy.ascontiguousarray(image).tofile(output)
+                frame_shape = list(image.shape)
+                n_frames += 1
+        except:
+            #E.g. a corrupt video or a full disk: do not leave the partial frames behind
+            output.close()
+            os.remove(frames_file + tmp_suffix)
+            raise
+        finally:
+            output.close()
+            frame_grabber.release()
+        os.rename(frames_file + tmp_suffix, frames_file)
+        index = { 'file' : os.path.abspath(i_file), 'scale' : i_scale, 'color' : bool(i_color),
+                  'n_frames' : n_frames, 'frame_shape' : frame_shape }
+        with open(index_file + tmp_suffix, 'w') as output:
+            json.dump(index, output)
+        os.rename(index_file + tmp_suffix, index_file)
+        
+    def remove(self, i_file, i_scale=1., i_color=False):
+        for file_name in self.paths(i_file, i_scale, i_color):
+            if os.path.exists(file_name):
+                os.remove(file_name)
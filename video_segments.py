@@ -0,0 +1,154 @@
+############################################################################
+#    Copyright 2010 Emli-Mari Nel
+#    This file is part of Opengazer-headtracker
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#    See <http://www.gnu.org/licenses/>
+############################################################################
+
+import multiprocessing
+import numpy
+import image_utils
+
+"""Decode a single video with several processes: the video is split into contiguous frame 
+   ranges, each worker opens its own capture, seeks to the start of its range and decodes 
+   (and optionally normalises and runs face detection on) its frames. The results are 
+   reassembled in frame order and are identical to the serial functions in image_utils."""
+
+def FrameRanges(i_n_frames, i_n_segments):
+    """Split the frames [0, i_n_frames) into at most i_n_segments (start, stop) ranges"""
+    bounds = numpy.int32(numpy.round(numpy.linspace(0, i_n_frames, i_n_segments + 1)))
+    return [ (int(bounds[n]), int(bounds[n+1])) for n in range(0, i_n_segments) if bounds[n+1] > bounds[n] ]
+
+def OpenSegment(i_file, i_start):
+    """Return a frame grabber of which the next frame is frame i_start"""
+    from frame_grabber import FrameGrabberFile
+    frame_grabber = FrameGrabberFile(i_file, i_loop_back = False)
+    if i_start == 0:
+        return frame_grabber
+    frame_grabber.setFramePos(i_start)
+    if frame_grabber.framePos() == i_start:
+        return frame_grabber
+    #Inexact seek: decode from the start of the file and skip the frames before i_start
+    frame_grabber.release()
+    frame_grabber = FrameGrabberFile(i_file, i_loop_back = False)
+    for n in range(0, i_start):
+        if frame_grabber.grabFrame() == None:
+            break
+    return frame_grabber
+
+def DecodeSegment(i_task):
+    """Worker: decode the frames [i_task['start'], i_task['stop']) of i_task['file'] (stop = None 
+       decodes up to the end of the file). Returns a dictionary with the number of frames and, as 
+       requested in i_task, the 'frames' (n x rows x cols), the 'normalised' images (n x rows x cols,
+       i_task['normaliser'] are IplImageNormaliser.getParams settings) and the detected 'boxes' 
+       (n x 4, (min_row, min_col, max_row, max_col) of ViolaJonesRoi with scale i_task['viola_scale'],
+       -1 if no face was found)."""
+    from image_normaliser import IplImageNormaliser
+    from roi_detector import ViolaJonesRoi
+    start = i_task['start']
+    stop = i_task['stop']
+    n_hint = 0
+    if stop is not None:
+        n_hint = stop - start
+    frame_grabber = OpenSegment(i_task['file'], start)
+    frame_grabber.useBufferPool()
+    pool = image_utils.IplBufferPool()
+    frames = image_utils.NumpyFrameBuffer(n_hint)
+    normalised = image_utils.NumpyFrameBuffer(n_hint)
+    boxes = image_utils.NumpyFrameBuffer(n_hint)
+    normaliser = None
+    if i_task['normaliser'] is not None:
+        normaliser = IplImageNormaliser()
+        normaliser.loadParams(i_task['normaliser'])
+    detector = None
+    if i_task['viola_scale'] is not None:
+        detector = ViolaJonesRoi( i_scale=i_task['viola_scale'] )
+    n_frames = 0
+    while (stop is None) or (n_frames < n_hint):
+        current_frame = frame_grabber.nextFrame()
+        if current_frame == None:
+            break
+        w = int( i_task['scale'] * float(current_frame.width) + 0.5 )
+        h = int( i_task['scale'] * float(current_frame.height) + 0.5 )
+        image = image_utils.IplResizeAndConvert(current_frame, w, h, i_pool=pool)
+        if i_task['keep_frames']:
+            frames.append( image_utils.IplNumpyView(image) )
+        if normaliser is not None:
+            normalised.append( image_utils.IplNumpyView( normaliser.normalise(image) ) )
+        if detector is not None:
+            box = detector.compute([image], i_ipl=True)
+            if box is None:
+                box = (-1, -1, -1, -1)
+            boxes.append( numpy.array(box, dtype=numpy.int32) )
+        n_frames += 1
+    frame_grabber.release()
+    return { 'n_frames' : n_frames, 'frames' : frames.result(), 'normalised' : normalised.result(), 
+             'boxes' : boxes.result() }
+
+def DecodeVideoParallel(i_file, i_scale=1., i_n_processes=None, i_keep_frames=True, 
+                        i_normaliser_params=None, i_viola_scale=None):
+    """Decode a video with i_n_processes worker processes (default: one per core), see 
+       DecodeSegment for the inputs and the dictionary returned. If the frame count of the 
+       container turns out to be wrong the video is decoded serially."""
+    from frame_grabber import FrameGrabberFile
+    if i_n_processes is None:
+        i_n_processes = multiprocessing.cpu_count()
+    frame_grabber = FrameGrabberFile(i_file, i_loop_back = False)
+    n_frames = frame_grabber.frameCount()
+    frame_grabber.release()
+    task = { 'file' : i_file, 'scale' : i_scale, 'keep_frames' : i_keep_frames, 
+             'normaliser' : i_normaliser_params, 'viola_scale' : i_viola_scale, 'start' : 0, 'stop' : None }
+    ranges = FrameRanges(n_frames, i_n_processes)
+    if len(ranges) < 2:
+        return DecodeSegment(task)
+    tasks = []
+    for (start, stop) in ranges:
+        segment_task = dict(task)
+        segment_task['start'] = start
+        segment_task['stop'] = stop
+        tasks.append(segment_task)
+    #The last segment decodes up to the end of the file, even if the frame count is too low 
+    tasks[-1]['stop'] = None
+    pool = multiprocessing.Pool( len(tasks) )
+    try:
+        results = pool.map(DecodeSegment, tasks, 1)
+    finally:
+        pool.close()
+        pool.join()
+    for n in range(0, len(tasks) - 1):
+        if results[n]['n_frames'] != (tasks[n]['stop'] - tasks[n]['start']):
+            return DecodeSegment(task)
+    o_result = { 'n_frames' : sum([result['n_frames'] for result in results]) }
+    for key in ['frames', 'normalised', 'boxes']:
+        data = [result[key] for result in results if result[key] is not None]
+        o_result[key] = None
+        if len(data) > 0:
+            o_result[key] = numpy.concatenate(data)
+    return o_result
+
+def Video2NumpyParallel(i_file, i_scale=1., i_n_processes=None):
+    """Parallel version of image_utils.Video2Numpy (rows x cols x frames)"""
+    frames = DecodeVideoParallel(i_file, i_scale, i_n_processes)['frames']
+    if frames is None:
+        return None
+    return numpy.rollaxis(frames, 0, 3)
+
+def Video2IplListParallel(i_file, i_scale=1., i_reverse_list=False, i_n_processes=None):
+    """Parallel version of image_utils.Video2IplList, the images are headers of one numpy array"""
+    frames = DecodeVideoParallel(i_file, i_scale, i_n_processes)['frames']
+    o_data = []
+    if frames is not None:
+        o_data = [image_utils.NumpyIplHeader(frames[n]) for n in range(0, frames.shape[0])]
+    if i_reverse_list:
+        o_data.reverse()
+    return o_data
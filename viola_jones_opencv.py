@@ -30,13 +30,13 @@ else:
 from opencv.cv import *
 from opencv.highgui import *
 import numpy
+import threading
+import os
 
 """Wrapper class for Viola Jones face detector (returns largest face rectangle, 
    no processing is done on the input image)"""
 
 # Global Variables
-g_cascade = None
-g_storage = cvCreateMemStorage(0)
 g_cascade_name = my_path + 'haarcascade_frontalface_alt.xml'
 #g_cascade_name = my_path + 'haarcascade_profileface.xml'
 
@@ -63,34 +63,195 @@ g_parameters = {
     },
 }
 
-def viola_jones_opencv(i_image, i_method='webcam', i_param=None):
+# One detector per thread and cascade file, see ThreadDetector
+g_thread_detectors = threading.local()
+# The parsed cascades of the process by cascade file, see SharedCascades
+g_cascade_pools = {}
+g_cascade_pools_lock = threading.Lock()
+
+def LoadCascade(i_cascade_name):
+    """Load an OpenCV cascade, raises IOError if that fails. Nothing is loaded when this 
+       module is imported: each detector loads its cascade when it is created."""
+    if not os.path.exists(i_cascade_name):
+        raise IOError, "Classifier cascade not found: " + i_cascade_name
+    o_cascade = cvLoadHaarClassifierCascade(i_cascade_name, cvSize(1,1))
+    if not o_cascade:
+        raise IOError, "Could not load classifier cascade: " + i_cascade_name
+    return o_cascade
+
+class CascadePool(object):
+    """The parsed OpenCV cascades of one cascade file, shared by the detectors of a process. 
+       cvHaarDetectObjects writes into the cascade, so a cascade is lent to one detector at a 
+       time: the xml file is only parsed again when all cascades are in use, i.e., at most once 
+       per thread detecting at the same time. Worker processes forked after load() inherit the 
+       parsed cascade."""
+    def __init__(self, i_cascade_name):
+        self.__cascade_name = i_cascade_name
+        self.__free = []
+        self.__n_parsed = 0
+        self.__lock = threading.Lock()
+        
+    def acquire(self):
+        """A cascade for the calling detector, raises IOError if it can not be loaded"""
+        self.__lock.acquire()
+        try:
+            if len(self.__free) > 0:
+                return self.__free.pop()
+        finally:
+            self.__lock.release()
+        o_cascade = LoadCascade(self.__cascade_name)
+        self.__lock.acquire()
+        self.__n_parsed += 1
+        self.__lock.release()
+        return o_cascade
+    
+    def release(self, i_cascade):
+        self.__lock.acquire()
+        self.__free.append(i_cascade)
+        self.__lock.release()
+        
+    def load(self):
+        """Parse a cascade now if none has been parsed, e.g., before forking worker processes"""
+        if self.__n_parsed == 0:
+            self.release( self.acquire() )
+            
+    def nParsed(self):
+        return self.__n_parsed
+
+def SharedCascades(i_cascade_name=None):
+    """The CascadePool of i_cascade_name in this process"""
+    if i_cascade_name is None:
+        i_cascade_name = g_cascade_name
+    g_cascade_pools_lock.acquire()
+    try:
+        if not g_cascade_pools.has_key(i_cascade_name):
+            g_cascade_pools[i_cascade_name] = CascadePool(i_cascade_name)
+        return g_cascade_pools[i_cascade_name]
+    finally:
+        g_cascade_pools_lock.release()
+
+def CascadeArrays(i_cascade_name=None):
+    """The cascade as numpy arrays (haar_cascade.HaarCascade), from the pre-parsed cache next to
+       the xml file when it is up to date"""
+    if i_cascade_name is None:
+        i_cascade_name = g_cascade_name
+    import haar_cascade
+    return haar_cascade.LoadCascade(i_cascade_name)
+
+def LargestBox(i_boxes):
+    """The largest of n x 4 boxes (min_row, min_col, max_row, max_col) as a tuple, None if n = 0"""
+    if i_boxes.shape[0] == 0:
+        return None
+    #The last of the largest faces, as the faces come in detection order
+    sizes = numpy.sqrt( numpy.asarray(i_boxes[:,2] - i_boxes[:,0], dtype=numpy.float64)**2 + 
+                        numpy.asarray(i_boxes[:,3] - i_boxes[:,1], dtype=numpy.float64)**2 )
+    best = len(sizes) - 1 - numpy.argmax(sizes[::-1])
+    return tuple([int(n) for n in i_boxes[best,:]])
+
+class ViolaJonesDetector(object):
+    """A face detector with its own memory storage and parameter profile (one of g_parameters or 
+       a dictionary with the same keys). The parsed cascade is borrowed from the SharedCascades of 
+       the process for each detection. OpenCV writes into the storage while detecting, so an 
+       instance must only be used by one thread at a time: use ThreadDetector to get the instance 
+       of the calling thread."""
+    def __init__(self, i_cascade_name=None, i_method='webcam', i_param=None):
+        if i_cascade_name is None:
+            i_cascade_name = g_cascade_name
+        self.__cascade_name = i_cascade_name
+        self.__cascades = SharedCascades(i_cascade_name)
+        #Raise IOError here if the cascade can not be loaded
+        self.__cascades.load()
+        self.__storage = cvCreateMemStorage(0)
+        self.setParams(i_method, i_param)
+        
+    def setParams(self, i_method='webcam', i_param=None):
+        if i_param is None:
+            i_param = g_parameters[i_method]
+        self.__param = dict(i_param)
+        
+    def params(self):
+        return dict(self.__param)
+    
+    def cascadeName(self):
+        return self.__cascade_name
+    
+    def detect(self, i_image, i_min_size=None, i_max_size=None, i_param=None):
+        """Returns the largest face in i_image (a cvMat) as a rectangle in matrix coordinates 
+           (min_row, min_col, max_row, max_col), None if no face was found.
+           i_min_size, i_max_size: optional face size limits in pixels, overriding the relative 
+           min_size of the parameters (faces larger than i_max_size are ignored).
+           i_param: parameters for this call only, instead of the parameter profile"""
+        return LargestBox( self.detectAll(i_image, i_min_size, i_max_size, i_param, i_all_faces=False) )
+    
+    def detectAll(self, i_image, i_min_size=None, i_max_size=None, i_param=None, i_all_faces=True):
+        """Returns all faces found in i_image as a n x 4 (int32) array of rectangles in matrix 
+           coordinates (min_row, min_col, max_row, max_col), see detect for the inputs. With
+           i_all_faces or i_max_size the CV_HAAR_FIND_BIGGEST_OBJECT flag of the parameters is 
+           ignored: the biggest face could be too large while a smaller face is valid."""
+        if i_param is None:
+            i_param = self.__param
+        if i_min_size is None:
+            search_width = int( float( i_image.width ) * i_param['min_size'] + 0.5 )
+            search_height = int( float( i_image.height ) * i_param['min_size'] + 0.5 )
+            max_length = max( search_width, search_height )
+        else:
+            max_length = int(i_min_size)
+        min_size = cvSize( max_length, max_length ) 
+        flags = i_param['haar_flags']
+        if i_all_faces or (i_max_size is not None):
+            flags = flags & ~CV_HAAR_FIND_BIGGEST_OBJECT
+        #The faces of the previous call are not referenced anymore
+        cvClearMemStorage( self.__storage )
+        cascade = self.__cascades.acquire()
+        try:
+            faces = cvHaarDetectObjects( i_image, cascade, self.__storage, i_param['window_scale'],
+                                        i_param['min_neighbors'], flags,  min_size )
+        finally:
+            self.__cascades.release(cascade)
+        if faces[0] == None:
+            return numpy.zeros((0, 4), dtype=numpy.int32)
+        rects = numpy.int32([ (f.y, f.x, f.height, f.width) for f in faces ]).reshape(-1, 4)
+        o_boxes = numpy.hstack( (rects[:,0:2], rects[:,0:2] + rects[:,2:4]) )
+        if i_max_size is not None:
+            o_boxes = o_boxes[ numpy.max(rects[:,2:4], axis=1) <= i_max_size, : ]
+        return o_boxes
+    
+def ThreadDetector(i_cascade_name=None, i_backend='opencv'):
+    """The detector of the calling thread for i_cascade_name, created on first use: threads 
+       detect concurrently without sharing a cascade or storage. 
+       i_backend: 'opencv' (ViolaJonesDetector) or 'numpy' (haar_detector.NumpyHaarDetector)"""
+    if i_cascade_name is None:
+        i_cascade_name = g_cascade_name
+    if not hasattr(g_thread_detectors, 'detectors'):
+        g_thread_detectors.detectors = {}
+    detectors = g_thread_detectors.detectors
+    key = (i_cascade_name, i_backend)
+    if not detectors.has_key(key):
+        if i_backend == 'opencv':
+            detectors[key] = ViolaJonesDetector(i_cascade_name)
+        elif i_backend == 'numpy':
+            import haar_detector
+            detectors[key] = haar_detector.NumpyHaarDetector(i_cascade_name)
+        else:
+            raise ValueError, "Unknown detection backend: " + str(i_backend)
+    return detectors[key]
+
+def viola_jones_opencv(i_image, i_method='webcam', i_param=None, i_min_size=None, i_max_size=None, i_all_faces=False,
+                       i_backend='opencv', i_cascade_name=None):
     # i_image should be a cvMat
     # returns a rectangle in matrix coordinates (min_row, min_col, max_row, max_col)
-    global g_cascade, g_parameters
+    # i_min_size, i_max_size: optional face size limits in pixels, overriding the relative 
+    # min_size of the parameters (faces larger than i_max_size are ignored)
+    # i_all_faces: return all faces as a n x 4 array of rectangles instead (n = 0 if none found)
+    # i_backend: 'opencv' (cvHaarDetectObjects) or 'numpy' (haar_detector.NumpyHaarDetector)
+    # i_cascade_name: the cascade of the detector (None: g_cascade_name)
+    # Runs the detector of the calling thread, see ThreadDetector
     if i_param is None:
         i_param = g_parameters[i_method]
-    search_width = int( float( i_image.width ) * i_param['min_size'] + 0.5 )
-    search_height = int( float( i_image.height ) * i_param['min_size'] + 0.5 )
-    max_length = max( search_width, search_height )
-    min_size = cvSize( max_length, max_length ) 
-    faces = cvHaarDetectObjects( i_image, g_cascade, g_storage, i_param['window_scale'],
-                                i_param['min_neighbors'], i_param['haar_flags'],  min_size )
-    if not(faces[0] == None):
-        max_size = 0
-        best_face = None
-        for f in faces:
-            s = numpy.sqrt( (float(f.height))**2 + (float(f.width))**2)
-            if s >= max_size:
-                max_size = s
-                best_face = (f.y, f.x , f.y + f.height , f.x + f.width )
-        return best_face
-    return None
-
-g_cascade = cvLoadHaarClassifierCascade(g_cascade_name, cvSize(1,1))
-if not g_cascade:
-    print "ERROR: Could not load classifier g_cascade"
-    import sys
-    sys.exit(-1)
+    detector = ThreadDetector(i_cascade_name, i_backend)
+    if i_all_faces:
+        return detector.detectAll(i_image, i_min_size, i_max_size, i_param)
+    return detector.detect(i_image, i_min_size, i_max_size, i_param)
     
 if __name__ == "__main__":
     import image_utils